@@ -0,0 +1,107 @@
+"""A semantic cache of the search app's answers.
+
+Every search costs an embedding, a vector search and a summary from the completions model. The
+same question is often asked again, word for word or in slightly different words, so answers
+are cached against the embedding of their query and reused for any new query whose embedding is
+close enough.
+"""
+import itertools
+import threading
+import time
+from collections import deque
+
+from config import ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES
+from vector_store import NumpyVectorStore
+
+
+# Queries that differ only in case and spacing are the same query
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+class AnswerCache:
+    """Cached answers, looked up by query text or by query embedding.
+
+    The cached embeddings are kept in an in-memory NumpyVectorStore. Answers expire after
+    ``ttl_seconds``, the oldest are dropped beyond ``max_entries``, and the whole cache is
+    cleared when the index version changes, i.e. when documents have been loaded or deleted
+    since the answers were cached.
+
+    Args:
+        similarity_threshold (float): Least cosine similarity between two queries for one to
+            reuse the other's answer.
+        ttl_seconds (float): How long an answer is reused for.
+        max_entries (int): Most answers kept.
+    """
+
+    def __init__(self, similarity_threshold=ANSWER_CACHE_SIMILARITY, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.index_version = None
+        self.clear()
+
+    def clear(self):
+        self.store = NumpyVectorStore()
+        self.answers = {}
+        # Keys oldest first, with the time each was cached and its normalised query
+        self.entries = deque()
+        self.exact = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Start again if the index has changed since the cached answers were found
+    def check_version(self, index_version):
+        with self.lock:
+            if index_version != self.index_version:
+                self.clear()
+                self.index_version = index_version
+
+    def _expire(self, now):
+        expired = []
+        while self.entries and (now - self.entries[0][1] > self.ttl_seconds
+                                or len(self.entries) > self.max_entries):
+            key, _, query = self.entries.popleft()
+            del self.answers[key]
+            # The same query may have been cached again since
+            if self.exact.get(query) == key:
+                del self.exact[query]
+            expired.append(key)
+        if expired:
+            self.store.delete(expired)
+
+    # Look up an answer for the exact query, which needs no embedding request
+    def get(self, query):
+        with self.lock:
+            self._expire(time.time())
+            key = self.exact.get(normalize_query(query))
+            if key is None:
+                return None
+            self.hits += 1
+            return self.answers[key]
+
+    # Look up an answer for a query whose embedding is close enough to the given one
+    def get_similar(self, embedded_query):
+        with self.lock:
+            self._expire(time.time())
+            docs = self.store.search(embedded_query, 1, return_fields=()).docs
+            # Scores are cosine distances
+            if docs and 1 - docs[0].vector_score >= self.similarity_threshold:
+                self.hits += 1
+                return self.answers[docs[0].id]
+            self.misses += 1
+            return None
+
+    def add(self, query, embedded_query, answer):
+        with self.lock:
+            now = time.time()
+            key = f"answer:{next(self.ids)}"
+            query = normalize_query(query)
+            self.store.add([key], [embedded_query], [{}])
+            self.answers[key] = answer
+            self.entries.append((key, now, query))
+            self.exact[query] = key
+            self._expire(now)
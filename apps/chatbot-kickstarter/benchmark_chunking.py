@@ -0,0 +1,72 @@
+"""Benchmark the sentence-aware chunker against the original decode-scan implementation.
+
+Extracts the text of the bundled F1 PDFs the same way the notebook does, cleans it up as ingestion
+does before chunking, chunks it with both implementations, checks the chunks are identical and
+reports the time each one took. Times include encoding the text, which both implementations do.
+
+    python benchmark_chunking.py
+    python benchmark_chunking.py data/fia_2023_formula_1_technical_regulations_-_issue_4_-_2022-12-07.pdf
+"""
+import argparse
+import os
+import time
+
+import textract
+import tiktoken
+
+from config import TEXT_EMBEDDING_CHUNK_SIZE
+from transformers import chunks, get_text_to_embed
+
+
+# The original chunker, which decodes every candidate chunk while scanning back for a sentence end
+def chunks_decode_scan(text, n, tokenizer):
+    tokens = tokenizer.encode(text)
+    i = 0
+    while i < len(tokens):
+        j = min(i + int(1.5 * n), len(tokens))
+        while j > i + int(0.5 * n):
+            chunk = tokenizer.decode(tokens[i:j])
+            if chunk.endswith(".") or chunk.endswith("\n"):
+                break
+            j -= 1
+        if j == i + int(0.5 * n):
+            j = min(i + n, len(tokens))
+        yield tokens[i:j]
+        i = j
+
+
+def time_chunker(chunker, text, n, tokenizer, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = list(chunker(text, n, tokenizer))
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdf_files", nargs="*")
+    parser.add_argument("--chunk-size", type=int, default=TEXT_EMBEDDING_CHUNK_SIZE)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    data_dir = os.path.join(os.curdir, "data")
+    pdf_files = args.pdf_files or sorted(
+        os.path.join(data_dir, x) for x in os.listdir(data_dir) if x.endswith(".pdf")
+    )
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+
+    print(f"{'file':<60}{'tokens':>9}{'chunks':>8}{'decode-scan s':>15}{'linear s':>10}{'speedup':>9}")
+    for pdf_path in pdf_files:
+        file_body_string = textract.process(pdf_path, method="pdfminer").decode("utf-8")
+        # Ingestion replaces line breaks before chunking, so most chunks end at a full stop
+        text = get_text_to_embed(os.path.basename(pdf_path), file_body_string)
+
+        old_seconds, old_chunks = time_chunker(chunks_decode_scan, text, args.chunk_size, tokenizer, args.repeats)
+        new_seconds, new_chunks = time_chunker(chunks, text, args.chunk_size, tokenizer, args.repeats)
+        if new_chunks != old_chunks:
+            raise AssertionError(f"Chunks differ for {pdf_path}")
+
+        print(f"{os.path.basename(pdf_path)[:59]:<60}{len(tokenizer.encode(text)):>9}{len(new_chunks):>8}"
+              f"{old_seconds:>15.3f}{new_seconds:>10.3f}{old_seconds / new_seconds:>8.1f}x")
@@ -0,0 +1,118 @@
+"""Benchmark recall@k against query latency for different vector index settings.
+
+Run this after the F1 documents have been loaded into Redis (see the notebook). The script
+reads every stored vector back out of Redis, computes exact (brute-force) nearest neighbours
+with NumPy as the ground truth, then builds temporary indexes over the same keys with the
+requested settings and reports recall@k and latency for each EF_RUNTIME value.
+
+    python benchmark_index.py --top-k 5 --m 8 16 32 --ef-construction 100 200 --ef-runtime 10 50 100
+"""
+import argparse
+import time
+
+import numpy as np
+
+from config import PREFIX, VECTOR_FIELD_NAME
+from database import get_redis_connection, create_hnsw_index, get_query_embedding, search_vectors
+
+# Sample questions to use as queries, in the style of the chatbot's users
+SAMPLE_QUESTIONS = [
+    "What is the cost cap for a power unit manufacturer?",
+    "What are the criteria for disqualification?",
+    "How many power units can a driver use in a season?",
+    "What is the minimum weight of the car?",
+    "When must teams submit their financial reports?",
+    "Which staff must be registered with the FIA?",
+    "What are the rules for tyre usage during practice sessions?",
+    "How is a breach of the financial regulations penalised?",
+    "What are the dimensions of the rear wing?",
+    "What happens if a race is suspended?",
+]
+
+
+# Read every stored chunk vector back out of Redis
+def fetch_corpus(redis_conn, prefix=PREFIX, vector_field_name=VECTOR_FIELD_NAME):
+    keys = sorted(redis_conn.scan_iter(match=f"{prefix}:*", count=1000))
+    p = redis_conn.pipeline(transaction=False)
+    for key in keys:
+        p.hget(key, vector_field_name)
+    vectors = p.execute()
+    corpus = [(key.decode(), vector) for key, vector in zip(keys, vectors) if vector]
+    matrix = np.vstack([np.frombuffer(vector, dtype=np.float32) for _, vector in corpus])
+    return [key for key, _ in corpus], matrix
+
+
+# Exact cosine top-k for each query, used as ground truth
+def brute_force_top_k(corpus_matrix, query_matrix, top_k):
+    corpus = corpus_matrix / np.linalg.norm(corpus_matrix, axis=1, keepdims=True)
+    queries = query_matrix / np.linalg.norm(query_matrix, axis=1, keepdims=True)
+    scores = queries @ corpus.T
+    return np.argsort(-scores, axis=1)[:, :top_k]
+
+
+# Wait for RediSearch to finish indexing the existing keys after an index is created
+def wait_for_indexing(redis_conn, index_name, poll_seconds=0.5):
+    while int(redis_conn.ft(index_name).info().get("indexing", 0)):
+        time.sleep(poll_seconds)
+
+
+def run_queries(redis_conn, index_name, query_matrix, top_k, ef_runtime):
+    latencies, results = [], []
+    for query in query_matrix:
+        start = time.perf_counter()
+        response = search_vectors(redis_conn, query, index_name, top_k=top_k, ef_runtime=ef_runtime)
+        latencies.append(time.perf_counter() - start)
+        results.append([doc.id for doc in response.docs])
+    return latencies, results
+
+
+def recall_at_k(results, ground_truth_keys):
+    hits = [len(set(found) & set(expected)) / len(expected) for found, expected in zip(results, ground_truth_keys)]
+    return float(np.mean(hits))
+
+
+def benchmark(args):
+    redis_conn = get_redis_connection()
+    keys, corpus_matrix = fetch_corpus(redis_conn)
+    print(f"Loaded {len(keys)} vectors from Redis")
+
+    query_matrix = np.vstack([get_query_embedding(question) for question in SAMPLE_QUESTIONS])
+    ground_truth = brute_force_top_k(corpus_matrix, query_matrix, args.top_k)
+    ground_truth_keys = [[keys[i] for i in row] for row in ground_truth]
+
+    # FLAT is exact, so it gives the latency of brute force inside Redis as a baseline
+    configs = [("FLAT", None, None)] if args.flat else []
+    configs += [("HNSW", m, ef_c) for m in args.m for ef_c in args.ef_construction]
+
+    print(f"{'algorithm':<10}{'M':>5}{'EF_C':>7}{'EF_R':>7}{'build s':>10}{'recall@' + str(args.top_k):>11}"
+          f"{'p50 ms':>9}{'p95 ms':>9}")
+    for algorithm, m, ef_construction in configs:
+        index_name = f"{args.index_prefix}-{algorithm.lower()}-{m}-{ef_construction}"
+        kwargs = {"m": m, "ef_construction": ef_construction} if algorithm == "HNSW" else {}
+        start = time.perf_counter()
+        create_hnsw_index(redis_conn, VECTOR_FIELD_NAME, vector_dimensions=corpus_matrix.shape[1],
+                          index_name=index_name, algorithm=algorithm, **kwargs)
+        wait_for_indexing(redis_conn, index_name)
+        build_seconds = time.perf_counter() - start
+
+        try:
+            for ef_runtime in (args.ef_runtime if algorithm == "HNSW" else [None]):
+                latencies, results = run_queries(redis_conn, index_name, query_matrix, args.top_k, ef_runtime)
+                latencies_ms = np.array(latencies) * 1000
+                print(f"{algorithm:<10}{m or '-':>5}{ef_construction or '-':>7}{ef_runtime or '-':>7}"
+                      f"{build_seconds:>10.2f}{recall_at_k(results, ground_truth_keys):>11.3f}"
+                      f"{np.percentile(latencies_ms, 50):>9.2f}{np.percentile(latencies_ms, 95):>9.2f}")
+        finally:
+            # Drop only the benchmark index, the documents themselves are shared with the app's index
+            redis_conn.ft(index_name).dropindex(delete_documents=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--m", type=int, nargs="+", default=[16])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[200])
+    parser.add_argument("--ef-runtime", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--no-flat", dest="flat", action="store_false", help="Skip the FLAT baseline index")
+    parser.add_argument("--index-prefix", default="f1-bench")
+    benchmark(parser.parse_args())
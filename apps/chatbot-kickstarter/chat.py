@@ -1,13 +1,13 @@
 import streamlit as st
 from streamlit_chat import message
 
-from database import get_redis_connection
 from chatbot import RetrievalAssistant, Message
+from service import get_service
 
-# Initialise database
+# Initialise the service layer
 
-## Initialise Redis connection
-redis_client = get_redis_connection()
+## One event loop, Redis connection pool and HTTP session shared by every session of the app
+service = get_service()
 
 # Set instruction
 
@@ -18,7 +18,7 @@ The Question is their query on Formula 1, and the Year is the year of the applic
 Think about this step by step:
 - The user will ask a Question
 - You will ask them for the Year if their question didn't include a Year
-- Once you have the Year, say "searching for answers".
+- Once you have the Year, call the search_knowledge_base function with the Question and Year.
 
 Example:
 
@@ -28,7 +28,7 @@ Assistant: Certainly, what year would you like this for?
 
 User: 2023 please.
 
-Assistant: Searching for answers.
+Assistant: (calls search_knowledge_base with the question "What is the cost cap for a power unit?" and the year 2023)
 '''
 
 ### CHATBOT APP
@@ -47,8 +47,15 @@ if 'generated' not in st.session_state:
 if 'past' not in st.session_state:
     st.session_state['past'] = []
 
+# Render the response as it streams in, then return the message added to the conversation history
 def query(question):
-    response = st.session_state['chat'].ask_assistant(question)
+    placeholder = st.empty()
+    partial_response = ''
+    for delta in st.session_state['chat'].ask_assistant_stream(question):
+        partial_response += delta
+        placeholder.markdown(partial_response + '▌')
+    placeholder.empty()
+    response = st.session_state['chat'].conversation_history[-1]
     return response
 
 prompt = st.text_input(f"What do you want to know: ", key="input")
@@ -57,7 +64,7 @@ if st.button('Submit', key='generationSubmit'):
 
     # Initialization
     if 'chat' not in st.session_state:
-        st.session_state['chat'] = RetrievalAssistant()
+        st.session_state['chat'] = RetrievalAssistant(service)
         messages = []
         system_message = Message('system',system_prompt)
         messages.append(system_message.message())
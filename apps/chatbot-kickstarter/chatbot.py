@@ -1,12 +1,41 @@
-import openai
+import json
+import re
 from termcolor import colored
 import streamlit as st
 
-from database import get_redis_connection, get_redis_results
+from history import ConversationHistory
+from service import get_service
 
-from config import CHAT_MODEL, COMPLETIONS_MODEL, INDEX_NAME
+# The assistant calls this function once it has a question and year, rather than saying
+# "searching for answers" and having a second model extract them from the conversation
+SEARCH_FUNCTION = {
+    "name": "search_knowledge_base",
+    "description": "Search the Formula 1 regulations for the answer to the user's question. "
+                   "Only call this once you know both the question and the year of the season it is about.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "question": {
+                "type": "string",
+                "description": "The user's latest question, rewritten to make sense without the rest of the conversation",
+            },
+            "year": {
+                "type": "integer",
+                "description": "The year of the Formula 1 season the question is about",
+            },
+        },
+        "required": ["question", "year"],
+    },
+}
 
-redis_client = get_redis_connection()
+# The season year in the assistant's year argument, or None if it didn't give one
+# The model doesn't always keep to the schema, so "2023 season" or "this year" can come back too
+def parse_year(year):
+    match = re.search(r'(?<!\d)(19|20)\d{2}(?!\d)', str(year))
+    return int(match.group(0)) if match else None
+
+# Shown while the search runs, as the function call itself has no content to stream
+SEARCHING_MESSAGE = 'Searching for answers...\n\n'
 
 # A basic class to create a message as a dict for chat
 class Message:
@@ -23,76 +52,125 @@ class Message:
 
 
 # New Assistant class to add a vector database call to its responses
+# Its OpenAI and vector store requests are made through a RetrievalService, by default the one
+# service shared by the whole process
 class RetrievalAssistant:
     
-    def __init__(self):
-        self.conversation_history = []  
+    def __init__(self, service=None):
+        self.service = service or get_service()
+        self.conversation_history = ConversationHistory()
 
-    def _get_assistant_response(self, prompt):
+    def _get_assistant_response(self, prompt, functions=None):
         try:
-            completion = openai.ChatCompletion.create(
-              model=CHAT_MODEL,
-              messages=prompt,
-              temperature=0.1
-            )
+            completion_message = self.service.run(self.service.chat_completion(prompt, functions))
             
             response_message = Message(
-                completion['choices'][0]['message']['role'],
-                completion['choices'][0]['message']['content']
-            )
-            return response_message.message()
+                completion_message['role'],
+                completion_message['content']
+            ).message()
+            if completion_message.get('function_call'):
+                response_message['function_call'] = completion_message['function_call']
+            return response_message
             
         except Exception as e:
 
-            return f'Request failed with exception {e}'
+            return Message('assistant', f'Request failed with exception {e}').message()
     
     # The function to retrieve Redis search results
 
-    def _get_search_results(self,prompt):
-        latest_question = prompt
-        search_content = get_redis_results(
-            redis_client,latest_question, 
-            INDEX_NAME
-        )['result'][0]
+    def _get_search_results(self, question, year=None):
+        # Narrow the search to documents for the requested season, plus documents not tied to a year
+        year = parse_year(year)
+        filters = {"year": [year, 0]} if year else None
+
+        # The season search and the unfiltered fallback run together, rather than waiting for the
+        # first to come back empty before starting the second
+        results = self.service.run(self.service.search_with_fallback(question, filters))
+        return results[0].result if results else ''
+
+    # The arguments the assistant called the search function with. They are sometimes malformed
+    # JSON, or cut short when a stream fails, so fall back to searching the user's latest message
+    # without a year
+    def _get_search_arguments(self, function_call):
+        try:
+            arguments = json.loads(function_call['arguments'] or '{}')
+        except json.JSONDecodeError:
+            arguments = {}
+        if not isinstance(arguments, dict):
+            arguments = {}
+        if not arguments.get('question'):
+            user_messages = [message['content'] for message in self.conversation_history.messages()
+                             if message['role'] == 'user']
+            arguments['question'] = user_messages[-1] if user_messages else ''
+        return arguments
 
-        return search_content
+    # Search for the question and year the assistant asked for and give the results to the Chatbot as fresh context
+    def _add_search_context(self, function_call):
+        arguments = self._get_search_arguments(function_call)
+        search_result = self._get_search_results(arguments['question'], arguments.get('year'))
         
+        # We insert an extra system prompt here to give fresh context to the Chatbot on how to use the Redis results
+        # In this instance we add it to the conversation history, but in production it may be better to hide
+        self.conversation_history.add_context(
+            {
+            "role": 'system',
+            "content": f'''
+            Answer the user's question using this content: {search_result}. 
+            If you cannot answer the question, say 'Sorry, I don't know the answer to this one'
+            '''
+            }
+        )
+
+    # Stream the assistant's response, yielding each delta as it is generated
+    def _stream_assistant_response(self, prompt, functions=None):
+        try:
+            yield from self.service.iterate(self.service.stream_chat_completion(prompt, functions))
+
+        except Exception as e:
+
+            yield {'content': f'Request failed with exception {e}'}
+
+    # Answer directly, or search when the assistant calls the search function and then answer
+    # That is two chat round trips per searched answer, with the search in between
     def ask_assistant(self, next_user_prompt):
         [self.conversation_history.append(x) for x in next_user_prompt]
-        assistant_response = self._get_assistant_response(self.conversation_history)
+        assistant_response = self._get_assistant_response(self.conversation_history.messages(), [SEARCH_FUNCTION])
         
-        # Answer normally unless the trigger sequence is used "searching_for_answers"
-        if 'searching for answers' in assistant_response['content'].lower():
-            question_extract = openai.Completion.create(
-                model = COMPLETIONS_MODEL, 
-                prompt=f'''
-                Extract the user's latest question and the year for that question from this 
-                conversation: {self.conversation_history}. Extract it as a sentence stating the Question and Year"
-            '''
-            )
-            search_result = self._get_search_results(question_extract['choices'][0]['text'])
-            
-            # We insert an extra system prompt here to give fresh context to the Chatbot on how to use the Redis results
-            # In this instance we add it to the conversation history, but in production it may be better to hide
-            self.conversation_history.insert(
-                -1,{
-                "role": 'system',
-                "content": f'''
-                Answer the user's question using this content: {search_result}. 
-                If you cannot answer the question, say 'Sorry, I don't know the answer to this one'
-                '''
-                }
-            )
+        if assistant_response.get('function_call'):
+            self._add_search_context(assistant_response['function_call'])
             
             assistant_response = self._get_assistant_response(
-                self.conversation_history
+                self.conversation_history.messages()
                 )
             
-            self.conversation_history.append(assistant_response)
-            return assistant_response
-        else:
-            self.conversation_history.append(assistant_response)
-            return assistant_response
+        self.conversation_history.append(assistant_response)
+        return assistant_response
+
+    # Streaming version of ask_assistant, yielding the response a delta at a time as it is generated
+    # A function call shows up in the first delta, so the user is told a search is under way straight away
+    def ask_assistant_stream(self, next_user_prompt):
+        [self.conversation_history.append(x) for x in next_user_prompt]
+        content = ''
+        function_call = None
+        for delta in self._stream_assistant_response(self.conversation_history.messages(), [SEARCH_FUNCTION]):
+            if delta.get('function_call'):
+                if function_call is None:
+                    function_call = {'name': '', 'arguments': ''}
+                    yield SEARCHING_MESSAGE
+                function_call['name'] += delta['function_call'].get('name', '')
+                function_call['arguments'] += delta['function_call'].get('arguments', '')
+            elif delta.get('content'):
+                content += delta['content']
+                yield delta['content']
+
+        if function_call:
+            self._add_search_context(function_call)
+            content = ''
+            for delta in self._stream_assistant_response(self.conversation_history.messages()):
+                if delta.get('content'):
+                    content += delta['content']
+                    yield delta['content']
+        self.conversation_history.append(Message('assistant', content).message())
             
     def pretty_print_conversation_history(
             self, 
@@ -5,3 +5,41 @@ TEXT_EMBEDDING_CHUNK_SIZE=300
 VECTOR_FIELD_NAME='content_vector'
 PREFIX = "sportsdoc"  
 INDEX_NAME = "f1-index"
+# Each document's mean chunk vector is stored as a record of its own, under a separate prefix and
+# index, so a search can first pick the closest documents and then only search their chunks
+# RediSearch prefixes are plain string prefixes, so DOC_PREFIX mustn't start with PREFIX
+DOC_PREFIX = "f1doc"
+DOC_INDEX_NAME = "f1-doc-index"
+# Ingestion manifests, the content hashes of each loaded file, are kept under MANIFEST_PREFIX,
+# which for the same reason mustn't start with PREFIX
+MANIFEST_PREFIX = "f1manifest"
+# Weight each chunk by its token count in the document vector, so short fragments count for less
+WEIGHT_DOCUMENT_VECTORS_BY_TOKENS = True
+# Set TWO_STAGE_SEARCH to search the chunks of the DOC_TOP_K closest documents only
+TWO_STAGE_SEARCH = False
+DOC_TOP_K = 3
+# Vector index parameters, defaults match RediSearch's own HNSW defaults
+INDEX_ALGORITHM = "HNSW"
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_RUNTIME = 10
+# Where vectors are stored: "redis" for a RediSearch server, or "numpy" for an in-process store
+# that is persisted to NUMPY_STORE_PATH, which suits small corpora such as the bundled F1 documents
+VECTOR_STORE = "redis"
+NUMPY_STORE_PATH = "local_index"
+# Ingestion pipeline settings, the rate limits should match your OpenAI account's embedding quota
+EMBEDDING_REQUESTS_PER_MINUTE = 3000
+EMBEDDING_TOKENS_PER_MINUTE = 1000000
+EMBEDDING_CONCURRENCY = 8
+# Per-request limits of the embeddings endpoint, chunks from several documents are packed up to these
+EMBEDDING_BATCH_MAX_INPUTS = 2048
+EMBEDDING_BATCH_MAX_TOKENS = 300000
+VECTOR_WRITE_BATCH_SIZE = 500
+# Most prompt tokens of conversation history sent to the chat model each turn, leaving room in
+# CHAT_MODEL's 4,096 token context for the reply
+HISTORY_MAX_TOKENS = 3000
+# The search app reuses a cached answer for a query at least this similar to an earlier one,
+# for up to ANSWER_CACHE_TTL_SECONDS or until documents are loaded or deleted
+ANSWER_CACHE_SIMILARITY = 0.97
+ANSWER_CACHE_TTL_SECONDS = 3600
+ANSWER_CACHE_MAX_ENTRIES = 1000
@@ -1,12 +1,32 @@
-import pandas as pd 
+import json
+from typing import NamedTuple
 import numpy as np
 import openai
 from redis import Redis
+from redis.exceptions import ResponseError
 from redis.commands.search.field import VectorField
-from redis.commands.search.field import TextField, NumericField
+from redis.commands.search.field import TextField, NumericField, TagField
 from redis.commands.search.query import Query
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 
-from config import EMBEDDINGS_MODEL, PREFIX, VECTOR_FIELD_NAME
+from config import (
+    EMBEDDINGS_MODEL,
+    PREFIX,
+    VECTOR_FIELD_NAME,
+    INDEX_NAME,
+    DOC_PREFIX,
+    DOC_INDEX_NAME,
+    MANIFEST_PREFIX,
+    DOC_TOP_K,
+    TWO_STAGE_SEARCH,
+    INDEX_ALGORITHM,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_RUNTIME,
+    VECTOR_STORE,
+    NUMPY_STORE_PATH,
+)
+from vector_store import VectorStore, NumpyVectorStore
 
 # Get a Redis connection
 def get_redis_connection(host='localhost',port='6379',db=0):
@@ -14,21 +34,85 @@ def get_redis_connection(host='localhost',port='6379',db=0):
     r = Redis(host=host, port=port, db=db,decode_responses=False)
     return r
 
+# Get the vector store selected in config, either a Redis connection or an in-process store
+def get_vector_store(store_type=VECTOR_STORE):
+    if store_type == "redis":
+        return get_redis_connection()
+    if store_type == "numpy":
+        return NumpyVectorStore(NUMPY_STORE_PATH)
+    raise ValueError(f"Unsupported vector store: {store_type}")
+
+# Build the vector field attributes for a HNSW or FLAT index
+def get_vector_field_attributes(vector_dimensions=1536, distance_metric='COSINE', algorithm=INDEX_ALGORITHM,
+                                m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef_runtime=HNSW_EF_RUNTIME):
+    attributes = {"TYPE": "FLOAT32", "DIM": vector_dimensions, "DISTANCE_METRIC": distance_metric}
+    if algorithm.upper() == "HNSW":
+        # M and EF_CONSTRUCTION trade build time and memory for recall, EF_RUNTIME is the default query-time beam
+        attributes.update({"M": m, "EF_CONSTRUCTION": ef_construction, "EF_RUNTIME": ef_runtime})
+    elif algorithm.upper() != "FLAT":
+        raise ValueError(f"Unsupported index algorithm: {algorithm}")
+    return attributes
+
 # Create a Redis index to hold our data
-def create_hnsw_index (redis_conn,vector_field_name,vector_dimensions=1536, distance_metric='COSINE'):
-    redis_conn.ft().create_index([
-        VectorField(vector_field_name, "HNSW", {"TYPE": "FLOAT32", "DIM": vector_dimensions, "DISTANCE_METRIC": distance_metric}),
+def create_hnsw_index (redis_conn,vector_field_name,vector_dimensions=1536, distance_metric='COSINE',
+                       index_name=INDEX_NAME, prefix=PREFIX, algorithm=INDEX_ALGORITHM,
+                       m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef_runtime=HNSW_EF_RUNTIME):
+    attributes = get_vector_field_attributes(vector_dimensions, distance_metric, algorithm,
+                                             m, ef_construction, ef_runtime)
+    redis_conn.ft(index_name).create_index([
+        VectorField(vector_field_name, algorithm.upper(), attributes),
         TextField("filename"),
+        # The filename again as a tag, to match whole filenames in two-stage searches
+        TagField("filename", as_name="filename_tag"),
         TextField("text_chunk"),        
-        NumericField("file_chunk_index")
-    ])
+        NumericField("file_chunk_index"),
+        # Season year parsed from the filename, 0 when the document isn't tied to a year
+        NumericField("year")
+    ],
+    # Only index our own document keys rather than every hash in the database
+    definition=IndexDefinition(prefix=[f"{prefix}:"], index_type=IndexType.HASH))
+
+# Create the index of document vectors, there are few enough of them for an exact FLAT index
+def create_document_index(redis_conn, vector_field_name, vector_dimensions=1536, distance_metric='COSINE',
+                          index_name=DOC_INDEX_NAME, prefix=DOC_PREFIX):
+    attributes = get_vector_field_attributes(vector_dimensions, distance_metric, algorithm="FLAT")
+    redis_conn.ft(index_name).create_index([
+        VectorField(vector_field_name, "FLAT", attributes),
+        TextField("filename"),
+        NumericField("chunk_count"),
+        NumericField("year")
+    ],
+    definition=IndexDefinition(prefix=[f"{prefix}:"], index_type=IndexType.HASH))
+
+# Create the document index the first time a document vector is loaded into Redis
+def ensure_document_index(client, vector_field_name, vector_dimensions=1536, index_name=DOC_INDEX_NAME):
+    if isinstance(client, VectorStore):
+        return
+    try:
+        client.ft(index_name).info()
+    except ResponseError:
+        create_document_index(client, vector_field_name, vector_dimensions, index_name=index_name)
+
+# Document vectors are kept apart from chunk vectors: under their own prefix and index in Redis,
+# or in a collection of their own next to an in-process store
+def get_document_store(client):
+    if isinstance(client, VectorStore):
+        return client.collection("documents")
+    return client
 
 # Create a Redis pipeline to load all the vectors and their metadata
-def load_vectors(client:Redis, input_list, vector_field_name):
+def load_vectors(client:Redis, input_list, vector_field_name, prefix=PREFIX):
+    if isinstance(client, VectorStore):
+        client.add([f"{prefix}:{text['id']}" for text in input_list],
+                   [text['vector'] for text in input_list],
+                   [text['metadata'] for text in input_list])
+        return
+
     p = client.pipeline(transaction=False)
+    p.incr(get_index_version_key())
     for text in input_list:    
         #hash key
-        key=f"{PREFIX}:{text['id']}"
+        key=f"{prefix}:{text['id']}"
         
         #hash values
         item_metadata = text['metadata']
@@ -41,42 +125,201 @@ def load_vectors(client:Redis, input_list, vector_field_name):
             
     p.execute()
 
+# Fetch stored vectors for the given chunk ids, None where a chunk isn't stored
+def get_vectors(client, ids, vector_field_name):
+    keys = [f"{PREFIX}:{id}" for id in ids]
+    if isinstance(client, VectorStore):
+        return client.get_vectors(keys)
+
+    p = client.pipeline(transaction=False)
+    for key in keys:
+        p.hget(key, vector_field_name)
+    return [None if vector is None else np.frombuffer(vector, dtype=np.float32) for vector in p.execute()]
+
+# Delete the given chunk ids
+def delete_vectors(client, ids):
+    keys = [f"{PREFIX}:{id}" for id in ids]
+    if not keys:
+        return
+    if isinstance(client, VectorStore):
+        client.delete(keys)
+    else:
+        p = client.pipeline(transaction=False)
+        p.delete(*keys)
+        p.incr(get_index_version_key())
+        p.execute()
+
+# A counter that goes up whenever vectors are loaded or deleted, so that anything cached from
+# earlier searches, such as the search app's answers, can tell when it is out of date. A local
+# store reloads itself here if another process has saved a newer version
+def get_index_version_key():
+    return f"{PREFIX}-version"
+
+def get_index_version(client):
+    if isinstance(client, VectorStore):
+        return client.refresh()
+    return int(client.get(get_index_version_key()) or 0)
+
+# The manifest of an ingested file holds the hash of the whole file and of each chunk.
+# MANIFEST_PREFIX doesn't start with PREFIX, so manifests are never indexed or searched
+def get_manifest_key(filename):
+    return f"{MANIFEST_PREFIX}:{filename}"
+
+def get_file_manifest(client, filename):
+    if isinstance(client, VectorStore):
+        return client.get_manifest(filename)
+
+    stored = client.hgetall(get_manifest_key(filename))
+    if not stored:
+        return None
+    return {"file_hash": stored[b"file_hash"].decode(), "chunk_hashes": json.loads(stored[b"chunk_hashes"])}
+
+def set_file_manifest(client, filename, manifest):
+    if isinstance(client, VectorStore):
+        client.set_manifest(filename, manifest)
+    else:
+        client.hset(get_manifest_key(filename),
+                    mapping={"file_hash": manifest["file_hash"], "chunk_hashes": json.dumps(manifest["chunk_hashes"])})
+
+# Write a local store to disk once a batch of changes is done. Redis persists writes itself
+def save_store(client):
+    if isinstance(client, VectorStore) and getattr(client, "path", None):
+        client.save()
+
+# Create an embedding vector for a user query
+def get_query_embedding(query):
+    return np.array(openai.Embedding.create(
+                                        input=query,
+                                        model=EMBEDDINGS_MODEL,
+                                    )["data"][0]['embedding'], dtype=np.float32)
+
+# Fields returned by a search unless the caller asks for fewer
+DEFAULT_RETURN_FIELDS = ('vector_score','filename','text_chunk','file_chunk_index')
+
+# RediSearch treats these characters as separators, so they need escaping inside a text term
+# Spaces are left alone so that several words are matched as separate terms
+REDIS_SPECIAL_CHARACTERS = set(',.<>{}[]"\':;!@#$%^&*()-+=~|/\\')
+
+def escape_query_text(value):
+    return ''.join(f'\\{char}' if char in REDIS_SPECIAL_CHARACTERS else char for char in str(value))
+
+# Tag attributes match whole values, and the text attribute each one is indexed from
+TAG_FIELDS = {"filename_tag": "filename"}
+
+# Inside a tag every special character, spaces included, needs escaping
+def escape_tag(value):
+    return ''.join(f'\\{char}' if char in REDIS_SPECIAL_CHARACTERS or char == ' ' else char for char in str(value))
+
+# Turn one metadata filter into a RediSearch clause
+# A str is a text match, a number an exact numeric match, a (min, max) tuple a numeric range
+# and a list any of its values
+def build_filter_clause(field, value):
+    if field in TAG_FIELDS:
+        values = value if isinstance(value, list) else [value]
+        return f'@{field}:{{{"|".join(escape_tag(item) for item in values)}}}'
+    if isinstance(value, list):
+        return '(' + ' | '.join(build_filter_clause(field, item) for item in value) + ')'
+    if isinstance(value, tuple):
+        low, high = value
+        return f'@{field}:[{low} {high}]'
+    if isinstance(value, (int, float)):
+        return f'@{field}:[{value} {value}]'
+    return f'@{field}:({escape_query_text(value)})'
+
+# Build the hybrid query: metadata filters narrow the candidate set before the KNN search runs
+def build_knn_query(top_k, filters=None, return_fields=DEFAULT_RETURN_FIELDS, ef_runtime=None):
+    prefilter = ' '.join(build_filter_clause(field, value) for field, value in (filters or {}).items())
+    prefilter = f'({prefilter})' if prefilter else '*'
+    # EF_RUNTIME overrides the index default for this query only (HNSW indexes only)
+    ef_clause = ' EF_RUNTIME $ef_runtime' if ef_runtime else ''
+    return Query(f'{prefilter}=>[KNN {top_k} @{VECTOR_FIELD_NAME} $vec_param{ef_clause} AS vector_score]') \
+        .sort_by('vector_score').paging(0,top_k).return_fields(*return_fields).dialect(2)
+
+# The parameters a query from build_knn_query is run with
+def build_knn_params(embedded_query, ef_runtime=None):
+    params_dict = {"vec_param": np.asarray(embedded_query, dtype=np.float32).tobytes()}
+    if ef_runtime:
+        params_dict["ef_runtime"] = ef_runtime
+    return params_dict
+
+# Search an in-process store, which filters on the text attribute a tag is indexed from
+def search_local_store(store, embedded_query, top_k=2, filters=None, return_fields=DEFAULT_RETURN_FIELDS):
+    filters = {TAG_FIELDS.get(field, field): value for field, value in (filters or {}).items()}
+    return store.search(embedded_query, top_k, return_fields=return_fields, filters=filters)
+
+# Run a KNN search for an already embedded query
+def search_vectors(redis_conn,embedded_query,index_name, top_k=2, ef_runtime=None,
+                   filters=None, return_fields=DEFAULT_RETURN_FIELDS):
+    if isinstance(redis_conn, VectorStore):
+        return search_local_store(redis_conn, embedded_query, top_k, filters, return_fields)
+
+    q = build_knn_query(top_k, filters, return_fields, ef_runtime)
+
+    #Execute the query
+    return redis_conn.ft(index_name).search(q, query_params = build_knn_params(embedded_query, ef_runtime))
+
+# Narrow a chunk search to the documents found by the first stage of a two-stage search
+def get_document_filters(document_result, filters=None):
+    filenames = [doc.filename for doc in document_result.docs]
+    return dict(filters or {}, filename_tag=filenames) if filenames else filters
+
+# Search the document vectors first, then only the chunks of the closest documents
+def search_documents_then_chunks(redis_conn, embedded_query, index_name, top_k=2, doc_top_k=DOC_TOP_K,
+                                 filters=None, return_fields=DEFAULT_RETURN_FIELDS):
+    documents = search_vectors(get_document_store(redis_conn), embedded_query, DOC_INDEX_NAME, top_k=doc_top_k,
+                               filters=filters, return_fields=('vector_score','filename'))
+    return search_vectors(redis_conn, embedded_query, index_name, top_k,
+                          filters=get_document_filters(documents, filters), return_fields=return_fields)
+
 # Make query to Redis
-def query_redis(redis_conn,query,index_name, top_k=2):
-    
-    
+def query_redis(redis_conn,query,index_name, top_k=2, ef_runtime=None, filters=None,
+                return_fields=DEFAULT_RETURN_FIELDS):
 
     ## Creates embedding vector from user query
-    embedded_query = np.array(openai.Embedding.create(
-                                                input=query,
-                                                model=EMBEDDINGS_MODEL,
-                                            )["data"][0]['embedding'], dtype=np.float32).tobytes()
+    embedded_query = get_query_embedding(query)
 
-    #prepare the query
-    q = Query(f'*=>[KNN {top_k} @{VECTOR_FIELD_NAME} $vec_param AS vector_score]').sort_by('vector_score').paging(0,top_k).return_fields('vector_score','filename','text_chunk','text_chunk_index').dialect(2) 
-    params_dict = {"vec_param": embedded_query}
+    return search_vectors(redis_conn, embedded_query, index_name, top_k, ef_runtime, filters, return_fields)
 
-    
-    #Execute the query
-    results = redis_conn.ft(index_name).search(q, query_params = params_dict)
-    
-    return results
+# A single search hit returned by get_redis_results
+class SearchResult(NamedTuple):
+    id: int
+    result: str
+    certainty: float
 
-# Get mapped documents from Weaviate results
-def get_redis_results(redis_conn,query,index_name):
-    
-    # Get most relevant documents from Redis
-    query_result = query_redis(redis_conn,query,index_name)
+# A lightweight list of search hits; pandas is only imported if a DataFrame is asked for
+class SearchResults(list):
+    __slots__ = ()
+
+    columns = list(SearchResult._fields)
+
+    # Column-style access so existing results['result'][0] lookups keep working
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return [getattr(result, key) for result in self]
+        return super().__getitem__(key)
+
+    def to_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(list(self), columns=self.columns)
+
+# The fields get_redis_results asks for, and how it maps them into typed results
+RESULT_FIELDS = ('vector_score','text_chunk')
+
+def to_search_results(query_result):
+    return SearchResults(
+        SearchResult(i, result.text_chunk, float(result.vector_score))
+        for i, result in enumerate(query_result.docs)
+    )
+
+# Get mapped documents from Redis results
+def get_redis_results(redis_conn,query,index_name, filters=None, embedded_query=None, two_stage=TWO_STAGE_SEARCH):
     
-    # Extract info into a list
-    query_result_list = []
-    for i, result in enumerate(query_result.docs):
-        result_order = i
-        text = result.text_chunk
-        score = result.vector_score
-        query_result_list.append((result_order,text,score))
-        
-    # Display result as a DataFrame for ease of us
-    result_df = pd.DataFrame(query_result_list)
-    result_df.columns = ['id','result','certainty']
-    return result_df
\ No newline at end of file
+    # Get most relevant documents from Redis, only fetching the fields we use
+    # Passing in the query's embedding saves embedding it again when searching more than once
+    if embedded_query is None:
+        embedded_query = get_query_embedding(query)
+    search = search_documents_then_chunks if two_stage else search_vectors
+    query_result = search(redis_conn, embedded_query, index_name, filters=filters,
+                          return_fields=RESULT_FIELDS)
+    return to_search_results(query_result)
@@ -0,0 +1,94 @@
+"""Conversation history for the chat model, kept within a token budget.
+
+Resending a whole session every turn makes prompts, and so latency and cost, grow with every
+question asked. ConversationHistory keeps what the model needs to carry on the conversation:
+the system prompt, the context from the latest search and as many recent turns as fit.
+"""
+from collections import deque
+
+import tiktoken
+
+from config import HISTORY_MAX_TOKENS
+
+# Every message costs a few tokens of formatting on top of its content, and every reply is primed
+# with a few more, see "How to count tokens with tiktoken" in the cookbook
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+class ConversationHistory:
+    """Chat messages to send with the next request, kept within ``max_tokens``.
+
+    System prompts are always kept. Only the most recent search context is kept, as earlier
+    search results were for earlier questions, and once the budget is used up the oldest turns
+    are dropped. Each message is counted once when it is added and a running total is kept, so
+    keeping to the budget costs O(1) amortised per turn however long the session gets.
+
+    Args:
+        max_tokens (int): Most prompt tokens the history may use.
+        encoding_name (str): The tiktoken encoding of the chat model.
+    """
+
+    def __init__(self, max_tokens=HISTORY_MAX_TOKENS, encoding_name="cl100k_base"):
+        self.max_tokens = max_tokens
+        self.tokenizer = tiktoken.get_encoding(encoding_name)
+        self.system_messages = []
+        self.turns = deque()
+        self.context = None
+        self.total_tokens = TOKENS_PER_REPLY
+
+    def count_tokens(self, message):
+        tokens = TOKENS_PER_MESSAGE + len(self.tokenizer.encode(message["role"]))
+        if message.get("content"):
+            tokens += len(self.tokenizer.encode(message["content"]))
+        if message.get("function_call"):
+            tokens += len(self.tokenizer.encode(message["function_call"]["name"]))
+            tokens += len(self.tokenizer.encode(message["function_call"]["arguments"]))
+        return tokens
+
+    def append(self, message):
+        # Entries are [message, tokens] so a dropped search context can be blanked in place
+        entry = [message, self.count_tokens(message)]
+        self.total_tokens += entry[1]
+        if message["role"] == "system":
+            self.system_messages.append(entry)
+        else:
+            self.turns.append(entry)
+            self._trim()
+
+    # Add search results for the latest message, just before it, replacing any earlier search context
+    def add_context(self, message):
+        if self.context:
+            self._drop(self.context)
+        self.context = [message, self.count_tokens(message)]
+        self.total_tokens += self.context[1]
+        latest = self.turns.pop()
+        self.turns.append(self.context)
+        self.turns.append(latest)
+        self._trim()
+
+    def _drop(self, entry):
+        self.total_tokens -= entry[1]
+        entry[0], entry[1] = None, 0
+
+    # Drop the oldest turns until the history fits the budget, always keeping the latest message
+    def _trim(self):
+        while self.total_tokens > self.max_tokens and len(self.turns) > 1:
+            self._drop(self.turns.popleft())
+        # Don't start the conversation with a reply to a question that has been dropped
+        while len(self.turns) > 1 and (self.turns[0][0] is None or self.turns[0][0]["role"] == "assistant"):
+            self._drop(self.turns.popleft())
+
+    # The messages to send with the next request
+    def messages(self):
+        return [message for message, _ in self.system_messages] + \
+               [message for message, _ in self.turns if message is not None]
+
+    def __iter__(self):
+        return iter(self.messages())
+
+    def __getitem__(self, index):
+        return self.messages()[index]
+
+    def __len__(self):
+        return len(self.system_messages) + sum(1 for message, _ in self.turns if message is not None)
@@ -0,0 +1,227 @@
+"""Ingest a folder of documents into the vector store with a staged, concurrent pipeline.
+
+The stages are connected by bounded queues, so memory use stays flat however many files there
+are, and a folder ingests at the speed of its slowest stage rather than the sum of all of them:
+
+1. Text extraction, cleaning and chunking run in a pool of worker processes.
+2. Chunks from all files are packed into embedding requests up to the per-request limits, which
+   run concurrently and are kept under the requests and tokens per minute limits.
+3. A single writer thread loads the vectors into the store in batches.
+
+Re-ingesting a folder is incremental in the same way as transformers.handle_file_string.
+
+    python ingest.py data/
+"""
+import argparse
+import functools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import textract
+import tiktoken
+
+from config import (
+    VECTOR_FIELD_NAME,
+    EMBEDDING_REQUESTS_PER_MINUTE,
+    EMBEDDING_TOKENS_PER_MINUTE,
+    EMBEDDING_CONCURRENCY,
+    VECTOR_WRITE_BATCH_SIZE,
+)
+from database import get_vector_store, get_file_manifest, load_vectors, save_store
+from transformers import (
+    RateLimiter,
+    EmbeddingBatcher,
+    prepare_file_string,
+    plan_file_update,
+    build_file_vectors,
+    build_document_vector,
+    get_document_weights,
+    EmbeddingAccumulator,
+    load_document_vector,
+    finish_file_update,
+)
+
+# Each worker process builds its own tokenizer once, rather than having it pickled with every file
+_tokenizer = None
+
+def _init_worker():
+    global _tokenizer
+    _tokenizer = tiktoken.get_encoding("cl100k_base")
+
+# Extract the raw text from a file, using textract for PDFs as the notebook does
+def extract_text(path):
+    if path.endswith(".txt"):
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    return textract.process(path, method="pdfminer").decode("utf-8")
+
+# Stage 1, run in a worker process
+def _prepare_path(path, known_file_hash):
+    return prepare_file_string((os.path.basename(path), extract_text(path)), _tokenizer, known_file_hash)
+
+
+class IngestionPipeline:
+    """Chunk, embed and load many files concurrently.
+
+    Args:
+        store: A Redis connection or VectorStore, as returned by database.get_vector_store.
+        vector_field_name (str): The field the vectors are stored in.
+        processes (int): Worker processes for extraction and chunking, defaults to the CPU count.
+        embedding_concurrency (int): Embedding requests in flight at once.
+        rate_limiter (RateLimiter): Shared limiter for embedding requests.
+        write_batch_size (int): Vectors written to the store per batch.
+        queue_size (int): Files buffered between stages before the earlier stage waits.
+        flush_interval (float): Seconds without new files after which a partly filled
+            embedding batch is sent anyway.
+    """
+
+    def __init__(self, store, vector_field_name=VECTOR_FIELD_NAME, processes=None,
+                 embedding_concurrency=EMBEDDING_CONCURRENCY, rate_limiter=None,
+                 write_batch_size=VECTOR_WRITE_BATCH_SIZE, queue_size=32, flush_interval=0.5):
+        self.store = store
+        self.vector_field_name = vector_field_name
+        self.processes = processes or os.cpu_count()
+        self.embedding_concurrency = embedding_concurrency
+        self.rate_limiter = rate_limiter or RateLimiter(EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE)
+        self.write_batch_size = write_batch_size
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    # Stage 2: embed the new or changed chunks of each file, packing chunks from many files per request
+    def _embed_stage(self, embed_queue, write_queue):
+        batcher = EmbeddingBatcher(concurrency=self.embedding_concurrency, rate_limiter=self.rate_limiter)
+        while True:
+            try:
+                item = embed_queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # Don't hold a partial batch back while the earlier stage is slow
+                batcher.flush()
+                continue
+            if item is None:
+                break
+            prepared, plan = item
+            new_indexes = plan["new_indexes"]
+            # The file's document vector is built up batch by batch as its chunks are embedded
+            accumulator = EmbeddingAccumulator()
+            result = batcher.add([prepared["text_chunks"][i] for i in new_indexes],
+                                 [prepared["chunk_token_counts"][i] for i in new_indexes],
+                                 accumulator, get_document_weights(prepared, new_indexes))
+            result.add_done_callback(functools.partial(self._on_embedded, write_queue, prepared, plan, accumulator))
+        batcher.close()
+
+    def _on_embedded(self, write_queue, prepared, plan, accumulator, result):
+        try:
+            new_embeddings = result.result()
+            self._count("chunks_embedded", len(plan["new_indexes"]))
+            self._count("chunks_reused", len(plan["reused_vectors"]))
+            write_queue.put((prepared, plan, build_file_vectors(prepared, plan, new_embeddings),
+                             build_document_vector(prepared, plan, accumulator)))
+        except Exception as e:
+            print("[ingest] Error creating embeddings for {}: {}".format(prepared["filename"], e))
+            self._count("files_failed")
+
+    # Stage 3: load vectors in batches, finishing each file once all of its vectors are written
+    def _write_worker(self, write_queue):
+        batch, pending_files = [], []
+
+        def flush():
+            try:
+                load_vectors(self.store, batch, self.vector_field_name)
+                for prepared, plan, document_vector in pending_files:
+                    load_document_vector(self.store, prepared, document_vector, self.vector_field_name)
+                    finish_file_update(self.store, prepared, plan)
+                save_store(self.store)
+                self._count("files_loaded", len(pending_files))
+            except Exception as e:
+                print(f"[ingest] Ran into a problem uploading to the vector store: {e}")
+                self._count("files_failed", len(pending_files))
+            batch.clear()
+            pending_files.clear()
+
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            prepared, plan, vectors, document_vector = item
+            batch.extend(vectors)
+            pending_files.append((prepared, plan, document_vector))
+            if len(batch) >= self.write_batch_size:
+                flush()
+        if pending_files:
+            flush()
+
+    def run(self, paths):
+        start = time.perf_counter()
+        embed_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+
+        writer = threading.Thread(target=self._write_worker, args=(write_queue,), daemon=True)
+        embedder = threading.Thread(target=self._embed_stage, args=(embed_queue, write_queue), daemon=True)
+        writer.start()
+        embedder.start()
+
+        # Stage 1: keep a bounded number of files in flight in the process pool
+        manifests = {}
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker) as pool:
+            remaining = iter(paths)
+            in_flight = {}
+            while True:
+                while len(in_flight) < 2 * self.processes:
+                    path = next(remaining, None)
+                    if path is None:
+                        break
+                    filename = os.path.basename(path)
+                    manifests[filename] = get_file_manifest(self.store, filename)
+                    known_file_hash = manifests[filename]["file_hash"] if manifests[filename] else None
+                    in_flight[pool.submit(_prepare_path, path, known_file_hash)] = filename
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename = in_flight.pop(future)
+                    try:
+                        prepared = future.result()
+                        if prepared is None:
+                            self._count("files_unchanged")
+                            continue
+                        plan = plan_file_update(self.store, prepared, manifests.pop(filename),
+                                                self.vector_field_name)
+                        # Blocks while the embedding stage is behind, which holds back the process pool
+                        embed_queue.put((prepared, plan))
+                    except Exception as e:
+                        print("[ingest] Error preparing {}: {}".format(filename, e))
+                        self._count("files_failed")
+
+        embed_queue.put(None)
+        embedder.join()
+        write_queue.put(None)
+        writer.join()
+
+        self.stats["seconds"] = round(time.perf_counter() - start, 2)
+        return self.stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--embedding-concurrency", type=int, default=EMBEDDING_CONCURRENCY)
+    parser.add_argument("--write-batch-size", type=int, default=VECTOR_WRITE_BATCH_SIZE)
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(args.folder, x) for x in os.listdir(args.folder)
+                   if x.lower().endswith((".pdf", ".txt")))
+    pipeline = IngestionPipeline(get_vector_store(), processes=args.processes,
+                                 embedding_concurrency=args.embedding_concurrency,
+                                 write_batch_size=args.write_batch_size)
+    print(pipeline.run(paths))
@@ -1,12 +1,45 @@
 import streamlit as st
-import openai 
 
-from database import get_redis_connection, get_redis_results
-from config import INDEX_NAME, COMPLETIONS_MODEL
-
-# initialise Redis connection
-
-client = get_redis_connection()
+from answer_cache import AnswerCache
+from service import get_service
+
+# initialise the service layer, which searches the vector store selected in config, Redis by default
+# One event loop, Redis connection pool and HTTP session shared by every session of the app
+service = get_service()
+
+# One answer cache shared by every session of the app
+@st.cache_resource(show_spinner=False)
+def get_answer_cache():
+    return AnswerCache()
+
+answer_cache = get_answer_cache()
+
+# Build a prompt to provide the original query, the result and ask to summarise for the user
+summary_prompt = '''Summarise this result in a bulleted list to answer the search query a customer has sent.
+Search query: SEARCH_QUERY_HERE
+Search result: SEARCH_RESULT_HERE
+Summary:
+'''
+
+# Answer a search query, run on the service's event loop so that one session's search never holds up another's
+async def answer_search(prompt):
+    answer_cache.check_version(await service.get_index_version())
+
+    # Repeated queries are answered from the cache without an embedding request,
+    # near repeats after embedding the query but without searching or summarising again
+    answer = answer_cache.get(prompt)
+    if answer is not None:
+        return answer
+    embedded_query = await service.get_query_embedding(prompt)
+    answer = answer_cache.get_similar(embedded_query)
+    if answer is not None:
+        return answer
+
+    results = await service.get_redis_results(prompt, embedded_query=embedded_query)
+    summary_prepped = summary_prompt.replace('SEARCH_QUERY_HERE',prompt).replace('SEARCH_RESULT_HERE',results[0].result)
+    answer = await service.completion(summary_prepped, max_tokens=500)
+    answer_cache.add(prompt, embedded_query, answer)
+    return answer
 
 ### SEARCH APP
 
@@ -21,19 +54,7 @@ st.subheader("Search for any Formula 1 rule questions you have")
 prompt = st.text_input("Enter your search here","", key="input")
 
 if st.button('Submit', key='generationSubmit'):
-    result_df = get_redis_results(client,prompt,INDEX_NAME)
-    
-    # Build a prompt to provide the original query, the result and ask to summarise for the user
-    summary_prompt = '''Summarise this result in a bulleted list to answer the search query a customer has sent.
-    Search query: SEARCH_QUERY_HERE
-    Search result: SEARCH_RESULT_HERE
-    Summary:
-    '''
-    summary_prepped = summary_prompt.replace('SEARCH_QUERY_HERE',prompt).replace('SEARCH_RESULT_HERE',result_df['result'][0])
-    summary = openai.Completion.create(engine=COMPLETIONS_MODEL,prompt=summary_prepped,max_tokens=500)
+    answer = service.run(answer_search(prompt))
     
     # Response provided by GPT-3
-    st.write(summary['choices'][0]['text'])
-
-    # Option to display raw table instead of summary from GPT-3
-    #st.table(result_df)
\ No newline at end of file
+    st.write(answer)
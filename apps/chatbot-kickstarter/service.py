@@ -0,0 +1,187 @@
+"""An asyncio service layer that the Streamlit apps make their OpenAI and Redis requests through.
+
+Streamlit runs every session's script in a thread of its own. Rather than each of those threads
+making blocking OpenAI and Redis calls, RetrievalService makes them from one event loop running
+in a background thread, with redis.asyncio and the OpenAI client's async methods. A script only
+waits for its own requests while the loop serves every session's requests at the same time,
+sharing one Redis connection pool and one HTTP session, so a single process can serve dozens of
+concurrent sessions.
+
+Each service starts a thread of its own, so a process shares one, from get_service, between
+every session of an app and every RetrievalAssistant:
+
+    service = get_service()
+    results = service.run(service.get_redis_results("What is the cost cap?"))
+"""
+import asyncio
+import threading
+
+import aiohttp
+import numpy as np
+import openai
+from redis.asyncio import Redis as AsyncRedis
+
+from config import (
+    CHAT_MODEL,
+    COMPLETIONS_MODEL,
+    EMBEDDINGS_MODEL,
+    INDEX_NAME,
+    DOC_INDEX_NAME,
+    DOC_TOP_K,
+    TWO_STAGE_SEARCH,
+    VECTOR_STORE,
+)
+from database import (
+    get_vector_store,
+    get_document_store,
+    get_document_filters,
+    build_knn_query,
+    build_knn_params,
+    search_local_store,
+    get_index_version_key,
+    to_search_results,
+    RESULT_FIELDS,
+    SearchResults,
+)
+from vector_store import VectorStore
+
+
+class RetrievalService:
+    """Async OpenAI and vector store requests, run on an event loop in a background thread.
+
+    Args:
+        host (str): The Redis host.
+        port (int): The Redis port.
+        db (int): The Redis database.
+        store_type (str): The vector store to search, as in config.VECTOR_STORE. The in-process
+            stores search in well under a millisecond, so they are called from the loop directly.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, store_type=VECTOR_STORE):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        if store_type == "redis":
+            self.store = AsyncRedis(host=host, port=port, db=db, decode_responses=False)
+        else:
+            self.store = get_vector_store(store_type)
+        self.session = self.run(self._create_session())
+
+    # The HTTP session has to be created on the loop that uses it
+    async def _create_session(self):
+        return aiohttp.ClientSession()
+
+    async def _with_session(self, coroutine):
+        # openai uses the session in this context variable rather than opening one per request
+        openai.aiosession.set(self.session)
+        return await coroutine
+
+    # Run a coroutine on the service's loop, blocking only the calling thread until it is done
+    def run(self, coroutine, timeout=None):
+        if getattr(self, "session", None):
+            coroutine = self._with_session(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    # Iterate an async generator on the service's loop from a synchronous caller
+    def iterate(self, async_iterator):
+        try:
+            while True:
+                try:
+                    yield self.run(async_iterator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            # If the caller stops early, let the generator clean up, e.g. close its response
+            self.run(async_iterator.aclose())
+
+    async def get_query_embedding(self, query):
+        response = await openai.Embedding.acreate(input=query, model=EMBEDDINGS_MODEL)
+        return np.array(response["data"][0]["embedding"], dtype=np.float32)
+
+    async def search_vectors(self, embedded_query, index_name=INDEX_NAME, top_k=2, ef_runtime=None,
+                             filters=None, return_fields=RESULT_FIELDS, store=None):
+        # The store to search, e.g. the document store, defaults to the chunk store
+        store = self.store if store is None else store
+        if isinstance(store, VectorStore):
+            return search_local_store(store, embedded_query, top_k, filters, return_fields)
+
+        q = build_knn_query(top_k, filters, return_fields, ef_runtime)
+        return await store.ft(index_name).search(q, query_params=build_knn_params(embedded_query, ef_runtime))
+
+    # The async counterpart of database.search_documents_then_chunks
+    async def search_documents_then_chunks(self, embedded_query, index_name=INDEX_NAME, top_k=2,
+                                           doc_top_k=DOC_TOP_K, filters=None):
+        documents = await self.search_vectors(embedded_query, DOC_INDEX_NAME, top_k=doc_top_k, filters=filters,
+                                              return_fields=('vector_score', 'filename'),
+                                              store=get_document_store(self.store))
+        return await self.search_vectors(embedded_query, index_name, top_k,
+                                         filters=get_document_filters(documents, filters))
+
+    # The async counterpart of database.get_redis_results
+    async def get_redis_results(self, query, index_name=INDEX_NAME, filters=None, embedded_query=None,
+                                two_stage=TWO_STAGE_SEARCH):
+        if embedded_query is None:
+            embedded_query = await self.get_query_embedding(query)
+        if two_stage:
+            query_result = await self.search_documents_then_chunks(embedded_query, index_name, filters=filters)
+        else:
+            query_result = await self.search_vectors(embedded_query, index_name, filters=filters)
+        return to_search_results(query_result)
+
+    # Embed the query once, then run the filtered search and an unfiltered fallback together,
+    # returning the filtered results unless nothing matched the filters
+    async def search_with_fallback(self, query, filters=None, index_name=INDEX_NAME):
+        embedded_query = await self.get_query_embedding(query)
+        searches = [self.get_redis_results(query, index_name, filters=filters, embedded_query=embedded_query)]
+        if filters:
+            searches.append(self.get_redis_results(query, index_name, embedded_query=embedded_query))
+        for results in await asyncio.gather(*searches):
+            if results:
+                return results
+        return SearchResults()
+
+    # The async counterpart of database.get_index_version
+    async def get_index_version(self):
+        if isinstance(self.store, VectorStore):
+            return self.store.refresh()
+        return int(await self.store.get(get_index_version_key()) or 0)
+
+    async def chat_completion(self, messages, functions=None, temperature=0.1):
+        kwargs = {"functions": functions} if functions else {}
+        completion = await openai.ChatCompletion.acreate(
+            model=CHAT_MODEL, messages=messages, temperature=temperature, **kwargs
+        )
+        return completion['choices'][0]['message']
+
+    # Yield each delta of a streamed chat completion as it arrives
+    async def stream_chat_completion(self, messages, functions=None, temperature=0.1):
+        kwargs = {"functions": functions} if functions else {}
+        completion = await openai.ChatCompletion.acreate(
+            model=CHAT_MODEL, messages=messages, temperature=temperature, stream=True, **kwargs
+        )
+        async for chunk in completion:
+            yield chunk['choices'][0]['delta']
+
+    async def completion(self, prompt, max_tokens=500):
+        completion = await openai.Completion.acreate(engine=COMPLETIONS_MODEL, prompt=prompt, max_tokens=max_tokens)
+        return completion['choices'][0]['text']
+
+    # Close the HTTP session and Redis connections, then stop the loop and its thread
+    def close(self):
+        self.run(self.session.close())
+        if not isinstance(self.store, VectorStore):
+            self.run(self.store.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+# The service shared by everything in this process, created the first time it is asked for
+_service = None
+_service_lock = threading.Lock()
+
+def get_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = RetrievalService()
+        return _service
@@ -1,20 +1,73 @@
+import hashlib
+import math
+import re
+import logging
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
 from typing import Iterator
-from numpy import array, average
 import openai
 import pandas as pd
 import numpy as np
 
-from config import TEXT_EMBEDDING_CHUNK_SIZE, EMBEDDINGS_MODEL
-from database import load_vectors
+from config import (
+    TEXT_EMBEDDING_CHUNK_SIZE,
+    EMBEDDINGS_MODEL,
+    EMBEDDING_BATCH_MAX_INPUTS,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    EMBEDDING_CONCURRENCY,
+    WEIGHT_DOCUMENT_VECTORS_BY_TOKENS,
+    DOC_PREFIX,
+)
+from database import (
+    load_vectors,
+    get_vectors,
+    delete_vectors,
+    get_file_manifest,
+    set_file_manifest,
+    save_store,
+    get_document_store,
+    ensure_document_index,
+)
 
-def get_col_average_from_list_of_lists(list_of_lists):
-    """Return the average of each column in a list of lists."""
-    if len(list_of_lists) == 1:
-        return list_of_lists[0]
-    else:
-        list_of_lists_array = array(list_of_lists)
-        average_embedding = average(list_of_lists_array, axis=0)
-        return average_embedding.tolist()
+# Failures that are worth waiting out: rate limits, timeouts, connection and server errors.
+# Anything else, such as a bad API key or an invalid request, fails the same way on every retry
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+# Keeps a running mean of embeddings as they arrive in batches, in float32, rather than holding on to
+# every embedding to average at the end. Embeddings can be weighted, e.g. by their chunk's token count
+class EmbeddingAccumulator:
+
+    def __init__(self):
+        self.total = None
+        self.weight = 0.0
+
+    def add(self, embeddings, weights=None):
+        if not len(embeddings):
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        if weights is None:
+            weights = np.ones(len(embeddings), dtype=np.float32)
+        weights = np.asarray(weights, dtype=np.float32)
+        batch_total = weights @ embeddings
+        if self.total is None:
+            self.total = batch_total
+        else:
+            self.total += batch_total
+        self.weight += float(weights.sum())
+
+    def mean(self):
+        if self.total is None or not self.weight:
+            return None
+        return self.total / self.weight
 
 # Create embeddings for a text using a tokenizer and an OpenAI engine
 
@@ -24,33 +77,217 @@ def create_embeddings_for_text(text, tokenizer):
     token_chunks = list(chunks(text, TEXT_EMBEDDING_CHUNK_SIZE, tokenizer))
     text_chunks = [tokenizer.decode(chunk) for chunk in token_chunks]
 
-    embeddings_response = get_embeddings(text_chunks, EMBEDDINGS_MODEL)
-    embeddings = [embedding["embedding"] for embedding in embeddings_response]
+    token_counts = [len(chunk) for chunk in token_chunks]
+    accumulator = EmbeddingAccumulator()
+    embeddings = embed_text_chunks(text_chunks, token_counts, accumulator,
+                                   token_counts if WEIGHT_DOCUMENT_VECTORS_BY_TOKENS else None)
     text_embeddings = list(zip(text_chunks, embeddings))
-
-    average_embedding = get_col_average_from_list_of_lists(embeddings)
+    average_embedding = accumulator.mean()
 
     return (text_embeddings, average_embedding)
 
 def get_embeddings(text_array, engine):
-    return openai.Engine(id=engine).embeddings(input=text_array)["data"]
+    # Parameters for exponential backoff
+    max_retries = 5 # Maximum number of retries
+    base_delay = 1 # Base delay in seconds
+    factor = 2 # Factor to multiply the delay by after each retry
+    while True:
+        try:
+            data = openai.Engine(id=engine).embeddings(input=text_array)["data"]
+            # Return the embeddings in the same order as the inputs
+            return sorted(data, key=lambda embedding: embedding["index"])
+        except RETRYABLE_ERRORS as e:
+            if max_retries > 0:
+                logging.warning(f"Request failed ({e}). Retrying in {base_delay} seconds.")
+                time.sleep(base_delay)
+                max_retries -= 1
+                base_delay *= factor
+            else:
+                raise e
+
+# Blocks callers so that embedding requests and tokens stay within per-minute limits
+class RateLimiter:
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Both budgets refill continuously, up to a minute's worth
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for name, capacity in self.capacity.items():
+            self.available[name] = min(capacity, self.available[name] + capacity * elapsed / 60)
+
+    # Wait until one request of the given number of tokens can be made
+    def acquire(self, tokens):
+        tokens = min(tokens, self.capacity["tokens"])
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available["requests"] >= 1 and self.available["tokens"] >= tokens:
+                    self.available["requests"] -= 1
+                    self.available["tokens"] -= tokens
+                    return
+                wait = 60 * max((1 - self.available["requests"]) / self.capacity["requests"],
+                                (tokens - self.available["tokens"]) / self.capacity["tokens"])
+            time.sleep(max(wait, 0.01))
+
+class EmbeddingBatcher:
+    """Pack texts from any number of documents into as few embedding requests as the limits allow.
+
+    Batches are filled across document boundaries up to ``max_inputs`` texts and ``max_tokens``
+    tokens, and up to ``concurrency`` requests run at once. ``add`` blocks once twice that many
+    batches are queued, so a fast producer can't run ahead of the API. A document's embeddings can
+    also be added to an EmbeddingAccumulator batch by batch, as each request completes.
+
+    Args:
+        engine (str): The embeddings model to use.
+        max_inputs (int): Most texts sent in a single request.
+        max_tokens (int): Most tokens sent in a single request.
+        concurrency (int): Requests in flight at once.
+        rate_limiter (RateLimiter): Optional limiter shared with other embedding callers.
+    """
+
+    def __init__(self, engine=EMBEDDINGS_MODEL, max_inputs=EMBEDDING_BATCH_MAX_INPUTS,
+                 max_tokens=EMBEDDING_BATCH_MAX_TOKENS, concurrency=EMBEDDING_CONCURRENCY, rate_limiter=None):
+        self.engine = engine
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.rate_limiter = rate_limiter
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = threading.BoundedSemaphore(2 * concurrency)
+        self.lock = threading.Lock()
+        self.batch = []
+        self.batch_tokens = 0
+
+    # Queue a document's texts, returning a Future for their embeddings in the same order
+    # If an accumulator is given, each batch's embeddings are added to it, with the given weights
+    def add(self, texts, token_counts, accumulator=None, weights=None):
+        result = Future()
+        if not texts:
+            result.set_result([])
+            return result
+        document = {"future": result, "embeddings": [None] * len(texts), "remaining": len(texts),
+                    "accumulator": accumulator, "weights": weights}
+        for position, (text, tokens) in enumerate(zip(texts, token_counts)):
+            with self.lock:
+                full = len(self.batch) >= self.max_inputs or self.batch_tokens + tokens > self.max_tokens
+                batch = self._take_batch() if self.batch and full else None
+                self.batch.append((document, position, text))
+                self.batch_tokens += tokens
+            if batch:
+                self._submit(*batch)
+        return result
+
+    # Send the current partial batch without waiting for it to fill up
+    def flush(self):
+        with self.lock:
+            batch = self._take_batch()
+        if batch[0]:
+            self._submit(*batch)
+
+    # Send anything left and wait for every request to finish
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    def _take_batch(self):
+        batch, tokens = self.batch, self.batch_tokens
+        self.batch, self.batch_tokens = [], 0
+        return batch, tokens
+
+    def _submit(self, batch, tokens):
+        self.slots.acquire()
+        self.executor.submit(self._embed_batch, batch, tokens)
+
+    def _embed_batch(self, batch, tokens):
+        error = None
+        try:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(tokens)
+            embeddings = [embedding["embedding"] for embedding in
+                          get_embeddings([text for _, _, text in batch], self.engine)]
+        except Exception as e:
+            error = e
+        finally:
+            self.slots.release()
+
+        completed, failed = [], []
+        accumulated = {}
+        with self.lock:
+            for i, (document, position, _) in enumerate(batch):
+                if document.get("failed"):
+                    continue
+                if error:
+                    # A document fails as a whole if any of its batches fails
+                    document["failed"] = True
+                    failed.append(document)
+                    continue
+                document["embeddings"][position] = embeddings[i]
+                document["remaining"] -= 1
+                if document["accumulator"] is not None:
+                    accumulated.setdefault(id(document), (document, []))[1].append(position)
+                if document["remaining"] == 0:
+                    completed.append(document)
+            # Add this batch to each document's running mean, before its future can resolve
+            for document, positions in accumulated.values():
+                weights = document["weights"]
+                document["accumulator"].add([document["embeddings"][position] for position in positions],
+                                            [weights[position] for position in positions] if weights else None)
+        # Resolve outside the lock, as callbacks attached to the futures run here
+        for document in failed:
+            document["future"].set_exception(error)
+        for document in completed:
+            document["future"].set_result(document["embeddings"])
+
+# Create embeddings for text chunks that have already been split, optionally adding them to an
+# EmbeddingAccumulator as each batch arrives
+def embed_text_chunks(text_chunks, token_counts=None, accumulator=None, weights=None):
+    if not text_chunks:
+        return []
+    # Without token counts only the input count limit applies
+    token_counts = token_counts or [0] * len(text_chunks)
+    batcher = EmbeddingBatcher()
+    result = batcher.add(text_chunks, token_counts, accumulator, weights)
+    batcher.close()
+    return result.result()
+
+# Token offsets at which a chunk would end a sentence, i.e. just after a token ending in a full stop or newline
+def get_sentence_end_offsets(tokens, tokenizer):
+    # A decoded chunk ends with "." or "\n" exactly when its last token's bytes do, so each distinct
+    # token only needs decoding once rather than decoding every candidate chunk
+    if hasattr(tokenizer, "decode_single_token_bytes"):
+        decode_token = tokenizer.decode_single_token_bytes
+    else:
+        def decode_token(token):
+            return tokenizer.decode([token]).encode("utf-8")
+    ends_sentence = {}
+    offsets = []
+    for k, token in enumerate(tokens):
+        if token not in ends_sentence:
+            ends_sentence[token] = decode_token(token).endswith((b".", b"\n"))
+        if ends_sentence[token]:
+            offsets.append(k + 1)
+    return offsets
 
 # Split a text into smaller chunks of size n, preferably ending at the end of a sentence
 def chunks(text, n, tokenizer):
     """Yield successive n-sized chunks from text."""
     tokens = tokenizer.encode(text)
+    sentence_ends = get_sentence_end_offsets(tokens, tokenizer)
     i = 0
     while i < len(tokens):
-        # Find the nearest end of sentence within a range of 0.5 * n and 1.5 * n tokens
+        # Find the furthest end of sentence within a range of 0.5 * n and 1.5 * n tokens
         j = min(i + int(1.5 * n), len(tokens))
-        while j > i + int(0.5 * n):
-            # Decode the tokens and check for full stop or newline
-            chunk = tokenizer.decode(tokens[i:j])
-            if chunk.endswith(".") or chunk.endswith("\n"):
-                break
-            j -= 1
+        k = bisect_right(sentence_ends, j) - 1
+        if k >= 0 and sentence_ends[k] > i + int(0.5 * n):
+            j = sentence_ends[k]
         # If no end of sentence found, use n tokens as the chunk size
-        if j == i + int(0.5 * n):
+        else:
             j = min(i + n, len(tokens))
         yield tokens[i:j]
         i = j
@@ -58,10 +295,125 @@ def chunks(text, n, tokenizer):
 def get_unique_id_for_file_chunk(filename, chunk_index):
     return str(filename+"-!"+str(chunk_index))
 
+# Get the season year a document applies to from its filename, or 0 if it doesn't name one
+# Years that start a date such as 2022-08-16 are issue dates rather than seasons, so they are skipped
+def get_year_from_filename(filename):
+    match = re.search(r'(?<!\d)(19|20)\d{2}(?!\d|-\d)', filename)
+    return int(match.group(0)) if match else 0
+
+# A stable fingerprint for a piece of text, used to detect unchanged files and chunks
+def get_content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Clean up a file string and add the filename to it, giving the text that gets embedded
+def get_text_to_embed(filename, file_body_string):
+    # Clean up the file string by replacing newlines, double spaces, and semi-colons
+    clean_file_body_string = file_body_string.replace("  ", " ").replace("\n", "; ").replace(';', ' ')
+    
+    # Add the filename to the text to embed
+    return "Filename is: {}; {}".format(filename, clean_file_body_string)
+
+# Chunk a file string and hash each chunk, returning None if it matches known_file_hash
+# This is the CPU-bound part of ingestion and needs no connection, so it can run in a worker process
+def prepare_file_string(file, tokenizer, known_file_hash=None):
+    filename, file_body_string = file
+    text_to_embed = get_text_to_embed(filename, file_body_string)
+
+    file_hash = get_content_hash(text_to_embed)
+    if file_hash == known_file_hash:
+        return None
+
+    token_chunks = list(chunks(text_to_embed, TEXT_EMBEDDING_CHUNK_SIZE, tokenizer))
+    text_chunks = [tokenizer.decode(chunk) for chunk in token_chunks]
+    return {"filename": filename,
+            "file_hash": file_hash,
+            "text_chunks": text_chunks,
+            "chunk_hashes": [get_content_hash(text_chunk) for text_chunk in text_chunks],
+            "chunk_token_counts": [len(chunk) for chunk in token_chunks]}
+
+# Work out which chunks of a prepared file need embedding, reusing the stored vector for the rest
+def plan_file_update(redis_conn, prepared, manifest, text_embedding_field):
+    filename = prepared["filename"]
+    old_chunk_hashes = manifest["chunk_hashes"] if manifest else []
+    old_index_by_hash = {chunk_hash: i for i, chunk_hash in enumerate(old_chunk_hashes)}
+    reused = {i: old_index_by_hash[chunk_hash] for i, chunk_hash in enumerate(prepared["chunk_hashes"])
+              if chunk_hash in old_index_by_hash}
+
+    reused_vectors = dict(zip(reused, get_vectors(
+        redis_conn, [get_unique_id_for_file_chunk(filename, old_i) for old_i in reused.values()],
+        text_embedding_field)))
+    # A reused chunk whose vector has gone missing gets embedded again
+    reused_vectors = {i: vector for i, vector in reused_vectors.items() if vector is not None}
+
+    return {"reused_vectors": reused_vectors,
+            # Chunks that kept both their content and their position need no write at all
+            "unchanged": {i for i in reused_vectors if reused[i] == i},
+            "new_indexes": [i for i in range(len(prepared["text_chunks"])) if i not in reused_vectors],
+            "old_chunk_count": len(old_chunk_hashes)}
+
+# Build the vectors to load for a prepared file once its new chunks have been embedded
+def build_file_vectors(prepared, plan, new_embeddings):
+    # Get the vectors array of triples: file_chunk_id, embedding, metadata for each embedding
+    # Metadata is a dict with keys: filename, text_chunk, file_chunk_index, year, chunk_hash
+    filename = prepared["filename"]
+    year = get_year_from_filename(filename)
+    new_embeddings = dict(zip(plan["new_indexes"], new_embeddings))
+    vectors = []
+    for i, text_chunk in enumerate(prepared["text_chunks"]):
+        if i in plan["unchanged"]:
+            continue
+        id = get_unique_id_for_file_chunk(filename, i)
+        embedding = new_embeddings[i] if i in new_embeddings else plan["reused_vectors"][i]
+        vectors.append({'id': id, "vector": embedding, 'metadata': {"filename": filename,
+                                                                    "text_chunk": text_chunk,
+                                                                    "file_chunk_index": i,
+                                                                    "year": year,
+                                                                    "chunk_hash": prepared["chunk_hashes"][i]}})
+    return vectors
+
+# Weights of a prepared file's chunks in its document vector, or None for a plain mean
+def get_document_weights(prepared, indexes):
+    if not WEIGHT_DOCUMENT_VECTORS_BY_TOKENS:
+        return None
+    return [prepared["chunk_token_counts"][i] for i in indexes]
+
+# The mean of a prepared file's chunk vectors, which represents the whole file in two-stage searches
+# The new chunks' embeddings are added to the accumulator batch by batch as they are embedded, so
+# only the reused vectors are left to add here
+def build_document_vector(prepared, plan, accumulator):
+    accumulator.add(list(plan["reused_vectors"].values()), get_document_weights(prepared, plan["reused_vectors"]))
+    return accumulator.mean()
+
+# Store a file's document vector as a record of its own, next to its chunks
+def load_document_vector(redis_conn, prepared, document_vector, text_embedding_field):
+    if document_vector is None:
+        return
+    store = get_document_store(redis_conn)
+    ensure_document_index(store, text_embedding_field, len(document_vector))
+    filename = prepared["filename"]
+    load_vectors(store, [{"id": filename, "vector": document_vector,
+                          "metadata": {"filename": filename,
+                                       "year": get_year_from_filename(filename),
+                                       "chunk_count": len(prepared["text_chunks"])}}],
+                 text_embedding_field, prefix=DOC_PREFIX)
+
+# Once a file's vectors are loaded, drop chunks beyond the end of the new version and record its manifest
+def finish_file_update(redis_conn, prepared, plan):
+    filename = prepared["filename"]
+    delete_vectors(redis_conn, [get_unique_id_for_file_chunk(filename, i)
+                                for i in range(len(prepared["text_chunks"]), plan["old_chunk_count"])])
+    # The manifest is written last so a failed load is retried in full next time
+    set_file_manifest(redis_conn, filename, {"file_hash": prepared["file_hash"],
+                                             "chunk_hashes": prepared["chunk_hashes"]})
+
 def handle_file_string(file, tokenizer, redis_conn, text_embedding_field, index_name):
     """
     Handle a file string by cleaning it up, creating embeddings, and uploading them to Redis.
 
+    Re-ingesting a file is incremental: unchanged files are skipped, chunks whose content hash
+    is already stored reuse their existing vector, and chunks that no longer exist are deleted.
+    See ingest.py for a pipeline that runs these steps concurrently across many files.
+
     Args:
         file (tuple): A tuple containing the filename and file body string.
         tokenizer: The tokenizer object to use for encoding and decoding text.
@@ -77,55 +429,86 @@ def handle_file_string(file, tokenizer, redis_conn, text_embedding_field, index_
 
     """
     filename = file[0]
-    file_body_string = file[1]
 
-    # Clean up the file string by replacing newlines, double spaces, and semi-colons
-    clean_file_body_string = file_body_string.replace("  ", " ").replace("\n", "; ").replace(';', ' ')
-    
-    # Add the filename to the text to embed
-    text_to_embed = "Filename is: {}; {}".format(filename, clean_file_body_string)
+    # Skip the file entirely if it hasn't changed since it was last loaded
+    manifest = get_file_manifest(redis_conn, filename)
+    prepared = prepare_file_string(file, tokenizer, manifest["file_hash"] if manifest else None)
+    if prepared is None:
+        print("[handle_file_string] {} is unchanged, skipping".format(filename))
+        return
 
     try:
-        # Create embeddings for the text
-        text_embeddings, average_embedding = create_embeddings_for_text(text_to_embed, tokenizer)
-        # print("[handle_file_string] Created embedding for {}".format(filename))
+        plan = plan_file_update(redis_conn, prepared, manifest, text_embedding_field)
+        accumulator = EmbeddingAccumulator()
+        new_embeddings = embed_text_chunks([prepared["text_chunks"][i] for i in plan["new_indexes"]],
+                                           [prepared["chunk_token_counts"][i] for i in plan["new_indexes"]],
+                                           accumulator, get_document_weights(prepared, plan["new_indexes"]))
+        print("[handle_file_string] {}: embedded {} new or changed chunks, reused {}".format(
+            filename, len(plan["new_indexes"]), len(plan["reused_vectors"])))
     except Exception as e:
         print("[handle_file_string] Error creating embedding: {}".format(e))
+        return
 
-    # Get the vectors array of triples: file_chunk_id, embedding, metadata for each embedding
-    # Metadata is a dict with keys: filename, file_chunk_index
-    vectors = []
-    for i, (text_chunk, embedding) in enumerate(text_embeddings):
-        id = get_unique_id_for_file_chunk(filename, i)
-        vectors.append({'id': id, "vector": embedding, 'metadata': {"filename": filename,
-                                                                    "text_chunk": text_chunk,
-                                                                    "file_chunk_index": i}})
+    vectors = build_file_vectors(prepared, plan, new_embeddings)
+    document_vector = build_document_vector(prepared, plan, accumulator)
 
     try:
         # Load vectors into Redis
         load_vectors(redis_conn, vectors, text_embedding_field)
+        load_document_vector(redis_conn, prepared, document_vector, text_embedding_field)
+        finish_file_update(redis_conn, prepared, plan)
+        save_store(redis_conn)
     except Exception as e:
         print(f'Ran into a problem uploading to Redis: {e}')
 
 
 # Make a class to generate batches for insertion
 class BatchGenerator:
-    
-    
+    """Split data into batches of at most ``batch_size`` items, without copying it.
+
+    DataFrames, Series and NumPy arrays are sliced into views, Arrow tables and record batches
+    with their zero-copy ``slice``, and any other iterable (for example a generator reading
+    records from disk) is consumed lazily, so memory per batch stays bounded however large the
+    input is. Every batch has exactly ``batch_size`` items except possibly the last one.
+    """
+
     def __init__(self, batch_size: int = 10) -> None:
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, got {batch_size}")
         self.batch_size = batch_size
-    
-    # Makes chunks out of an input DataFrame
-    def to_batches(self, df: pd.DataFrame) -> Iterator[pd.DataFrame]:
-        splits = self.splits_num(df.shape[0])
-        if splits <= 1:
-            yield df
+
+    # Makes chunks out of an input DataFrame, Arrow table or iterable
+    def to_batches(self, data) -> Iterator:
+        # pyarrow Tables and RecordBatches, checked by shape so pyarrow stays an optional dependency
+        if hasattr(data, "num_rows") and hasattr(data, "slice"):
+            for start in range(0, data.num_rows, self.batch_size):
+                yield data.slice(start, self.batch_size)
+        elif isinstance(data, (pd.DataFrame, pd.Series)):
+            for start in range(0, len(data), self.batch_size):
+                yield data.iloc[start:start + self.batch_size]
+        elif isinstance(data, np.ndarray):
+            for start in range(0, len(data), self.batch_size):
+                yield data[start:start + self.batch_size]
         else:
-            for chunk in np.array_split(df, splits):
-                yield chunk
+            iterator = iter(data)
+            while True:
+                batch = list(islice(iterator, self.batch_size))
+                if not batch:
+                    return
+                yield batch
 
-    # Determines how many chunks DataFrame contains
+    # Determines how many batches a given number of elements is split into
     def splits_num(self, elements: int) -> int:
-        return round(elements / self.batch_size)
-    
+        return math.ceil(elements / self.batch_size)
+
+    # Stream a CSV file from disk as DataFrames of at most batch_size rows
+    def from_csv(self, path: str, **read_csv_kwargs) -> Iterator[pd.DataFrame]:
+        with pd.read_csv(path, chunksize=self.batch_size, **read_csv_kwargs) as reader:
+            yield from reader
+
+    # Stream a Parquet file from disk as Arrow record batches of at most batch_size rows
+    def from_parquet(self, path: str, columns=None) -> Iterator:
+        import pyarrow.parquet as pq
+        yield from pq.ParquetFile(path).iter_batches(batch_size=self.batch_size, columns=columns)
+
     __call__ = to_batches
@@ -9,78 +9,158 @@ from langchain import SerpAPIWrapper, LLMChain
 from langchain.chat_models import ChatOpenAI
 from typing import List, Union
 from langchain.schema import AgentAction, AgentFinish, HumanMessage
-from langchain.memory import ConversationBufferWindowMemory
+from pydantic import PrivateAttr
+from concurrent.futures import ThreadPoolExecutor
 import openai
 import re
 import streamlit as st
 
-from database import get_redis_results, get_redis_connection
-from config import RETRIEVAL_PROMPT, CHAT_MODEL, INDEX_NAME, SYSTEM_PROMPT
-
+from database import get_redis_results, get_vector_store, fuse_results
+from context_packer import pack_context
+from memory import TokenBudgetMemory
+from tool_cache import ToolCache, normalize_tool_input
+from config import (
+    RETRIEVAL_PROMPT,
+    CHAT_MODEL,
+    INDEX_NAME,
+    SYSTEM_PROMPT,
+    HYDE_PROMPT,
+    HYDE_MAX_TOKENS,
+    HYDE_MIN_CHARS,
+    ROUTER_MAX_DISTANCE,
+    MEMORY_MAX_TOKENS,
+    MEMORY_SUMMARY_MAX_TOKENS,
+    TOOL_CACHE_GLOBAL_SIZE,
+)
 
-redis_client = get_redis_connection()
 
+redis_client = get_vector_store()
 
-def answer_user_question(query):
+# Runs the plain vector searches that overlap hypothetical answer generation
+search_executor = ThreadPoolExecutor(max_workers=8)
 
-    results = get_redis_results(redis_client, query, INDEX_NAME)
+# Plain searches of a question, shared by the router and the search functions, so that a
+# question the router hands to the agent isn't searched again by the agent's Search tool
+search_cache = ToolCache(TOOL_CACHE_GLOBAL_SIZE)
 
-    results.to_csv("results.csv")
 
-    search_content = ""
-    for x, y in results.head(3).iterrows():
-        search_content += y["title"] + "\n" + y["result"] + "\n\n"
+def search_question(query):
+    key = ("search", normalize_tool_input(query))
+    results = search_cache.get(key)
+    if results is None:
+        results = get_redis_results(redis_client, query, INDEX_NAME)
+        search_cache.set(key, results)
+    return results
 
-    retrieval_prepped = RETRIEVAL_PROMPT.format(
-        SEARCH_QUERY_HERE=query, SEARCH_CONTENT_HERE=search_content
-    )
 
-    retrieval = openai.ChatCompletion.create(
-        model=CHAT_MODEL,
-        messages=[{"role": "user", "content": retrieval_prepped}],
-        max_tokens=500,
-    )
+# Search results are appended to results_log, a session's bounded deque of
+# (query, results) pairs, so the app can show them without a round trip to disk
+def answer_user_question(query, results_log=None):
 
-    # Response provided by GPT-3.5
-    return retrieval["choices"][0]["message"]["content"]
+    results = search_question(query)
 
+    if results_log is not None:
+        results_log.append((query, results))
 
-def answer_question_hyde(query):
+    return summarise_results(query, results)
 
-    hyde_prompt = """You are OracleGPT, an helpful expert who answers user questions to the best of their ability.
-    Provide a confident answer to their question. If you don't know the answer, make the best guess you can based on the context of the question.
 
-    User question: {USER_QUESTION_HERE}
-    
-    Answer:"""
+def answer_question_hyde(query, results_log=None):
 
     hypothetical_answer = openai.ChatCompletion.create(
         model=CHAT_MODEL,
         messages=[
             {
                 "role": "user",
-                "content": hyde_prompt.format(USER_QUESTION_HERE=query),
+                "content": HYDE_PROMPT.format(USER_QUESTION_HERE=query),
             }
         ],
     )["choices"][0]["message"]["content"]
     # st.write(hypothetical_answer)
     results = get_redis_results(redis_client, hypothetical_answer, INDEX_NAME)
 
-    results.to_csv("results.csv")
+    if results_log is not None:
+        results_log.append((query, results))
+
+    return summarise_results(query, results)
+
+
+# Route plain lookups around the agent: if the best plain search result for the question
+# is close enough, answer with search_tool, the agent's Search tool for the selected search
+# mode, saving the agent's own LLM calls. Returns None for questions the agent should handle
+def answer_directly(query, search_tool, max_distance=ROUTER_MAX_DISTANCE):
+
+    results = search_question(query)
+    if not results or results[0].certainty > max_distance:
+        return None
+
+    return search_tool(query)
+
+
+# Stream a hypothetical answer, stopping at the first sentence end after min_chars
+# characters rather than waiting for the whole answer
+def stream_hypothetical_answer(
+    query, max_tokens=HYDE_MAX_TOKENS, min_chars=HYDE_MIN_CHARS
+):
+    response = openai.ChatCompletion.create(
+        model=CHAT_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": HYDE_PROMPT.format(USER_QUESTION_HERE=query),
+            }
+        ],
+        max_tokens=max_tokens,
+        stream=True,
+    )
+    hypothetical_answer = ""
+    try:
+        for chunk in response:
+            hypothetical_answer += chunk["choices"][0]["delta"].get("content", "")
+            sentence_end = hypothetical_answer.rstrip().endswith((".", "!", "?"))
+            if len(hypothetical_answer) >= min_chars and sentence_end:
+                break
+    finally:
+        # Stop reading the stream, so the rest of the answer isn't waited for
+        response.close()
+    return hypothetical_answer
+
+
+# HyDE with the plain query searched while the hypothetical answer is written,
+# fusing both searches' results with reciprocal rank fusion
+def answer_question_parallel_hyde(query, results_log=None):
 
-    search_content = ""
-    for x, y in results.head(3).iterrows():
-        search_content += y["title"] + "\n" + y["result"] + "\n\n"
+    plain_search = search_executor.submit(search_question, query)
+    try:
+        hypothetical_answer = stream_hypothetical_answer(query)
+        hyde_results = get_redis_results(redis_client, hypothetical_answer, INDEX_NAME)
+    except Exception:
+        # The plain search is still worth answering from
+        hyde_results = []
+    results = fuse_results(plain_search.result(), hyde_results)
 
-    retrieval_prepped = RETRIEVAL_PROMPT.replace("SEARCH_QUERY_HERE", query).replace(
-        "SEARCH_CONTENT_HERE", search_content
+    if results_log is not None:
+        results_log.append((query, results))
+
+    return summarise_results(query, results)
+
+
+# Summarise the top search results as an answer to the query
+def summarise_results(query, results):
+
+    search_content = pack_context(results)
+
+    retrieval_prepped = RETRIEVAL_PROMPT.format(
+        SEARCH_QUERY_HERE=query, SEARCH_CONTENT_HERE=search_content
     )
+
     retrieval = openai.ChatCompletion.create(
         model=CHAT_MODEL,
         messages=[{"role": "user", "content": retrieval_prepped}],
         max_tokens=500,
     )
 
+    # Response provided by GPT-3.5
     return retrieval["choices"][0]["message"]["content"]
 
 
@@ -90,40 +170,83 @@ class CustomPromptTemplate(BaseChatPromptTemplate):
     template: str
     # The list of tools available
     tools: List[Tool]
+    # The tool descriptions and names, which are the same for every step
+    _tools_block: str = PrivateAttr(default=None)
+    _tool_names: str = PrivateAttr(default=None)
+    # The scratchpad built so far, how many steps it covers and the last of them
+    _scratchpad: str = PrivateAttr(default="")
+    _scratchpad_size: int = PrivateAttr(default=0)
+    _scratchpad_last: tuple = PrivateAttr(default=None)
+
+    # Extend the scratchpad with the steps taken since it was last built, rather than
+    # rebuilding it from every step's action and (often long) observation each time
+    def build_scratchpad(self, intermediate_steps):
+        size = self._scratchpad_size
+        # A new run starts with different steps, so start again
+        if len(intermediate_steps) < size or (
+            size and intermediate_steps[size - 1] is not self._scratchpad_last
+        ):
+            self._scratchpad, size = "", 0
+        new_steps = intermediate_steps[size:]
+        if new_steps:
+            self._scratchpad += "".join(
+                f"{action.log}\nObservation: {observation}\nThought: "
+                for action, observation in new_steps
+            )
+            self._scratchpad_last = intermediate_steps[-1]
+        self._scratchpad_size = len(intermediate_steps)
+        return self._scratchpad
 
     def format_messages(self, **kwargs) -> str:
         # Get the intermediate steps (AgentAction, Observation tuples)
         # Format them in a particular way
         intermediate_steps = kwargs.pop("intermediate_steps")
-        thoughts = ""
-        for action, observation in intermediate_steps:
-            thoughts += action.log
-            thoughts += f"\nObservation: {observation}\nThought: "
         # Set the agent_scratchpad variable to that value
-        kwargs["agent_scratchpad"] = thoughts
-        # Create a tools variable from the list of tools provided
-        kwargs["tools"] = "\n".join(
-            [f"{tool.name}: {tool.description}" for tool in self.tools]
-        )
-        # Create a list of tool names for the tools provided
-        kwargs["tool_names"] = ", ".join([tool.name for tool in self.tools])
+        kwargs["agent_scratchpad"] = self.build_scratchpad(intermediate_steps)
+        if self._tools_block is None:
+            # Create a tools variable from the list of tools provided
+            self._tools_block = "\n".join(
+                [f"{tool.name}: {tool.description}" for tool in self.tools]
+            )
+            # Create a list of tool names for the tools provided
+            self._tool_names = ", ".join([tool.name for tool in self.tools])
+        kwargs["tools"] = self._tools_block
+        kwargs["tool_names"] = self._tool_names
         formatted = self.template.format(**kwargs)
         return [HumanMessage(content=formatted)]
 
 
+FINAL_ANSWER = "Final Answer:"
+ACTION_REGEX = r"Action\s*\d*\s*:(.*?)\nAction\s*\d*\s*Input\s*\d*\s*:[\s]*(.*)"
+ACTION_PATTERN = re.compile(ACTION_REGEX, re.DOTALL)
+
+
+# Match the action only where "Action" starts a line, found with str.find, falling back to
+# searching anywhere for output that puts it mid-line
+def match_action(llm_output):
+    start = llm_output.find("Action")
+    while start != -1:
+        if start == 0 or llm_output[start - 1] == "\n":
+            match = ACTION_PATTERN.match(llm_output, start)
+            if match:
+                return match
+        start = llm_output.find("Action", start + 1)
+    return ACTION_PATTERN.search(llm_output)
+
+
 class CustomOutputParser(AgentOutputParser):
     def parse(self, llm_output: str) -> Union[AgentAction, AgentFinish]:
         # Check if agent should finish
-        if "Final Answer:" in llm_output:
+        _, final_answer, answer = llm_output.rpartition(FINAL_ANSWER)
+        if final_answer:
             return AgentFinish(
                 # Return values is generally always a dictionary with a single `output` key
                 # It is not recommended to try anything else at the moment :)
-                return_values={"output": llm_output.split("Final Answer:")[-1].strip()},
+                return_values={"output": answer.strip()},
                 log=llm_output,
             )
         # Parse out the action and action input
-        regex = r"Action\s*\d*\s*:(.*?)\nAction\s*\d*\s*Input\s*\d*\s*:[\s]*(.*)"
-        match = re.search(regex, llm_output, re.DOTALL)
+        match = match_action(llm_output)
         if not match:
             raise ValueError(f"Could not parse LLM output: `{llm_output}`")
         action = match.group(1).strip()
@@ -143,13 +266,18 @@ def initiate_agent(tools):
         input_variables=["input", "intermediate_steps", "history"],
     )
 
-    # Initiate the memory with k=2 to keep the last two turns
+    # Keep recent turns and the summary of older ones within MEMORY_MAX_TOKENS tokens
     # Provide the memory to the agent
-    memory = ConversationBufferWindowMemory(k=2)
+    memory = TokenBudgetMemory(
+        llm=ChatOpenAI(temperature=0, max_tokens=MEMORY_SUMMARY_MAX_TOKENS),
+        max_token_limit=MEMORY_MAX_TOKENS,
+        max_summary_tokens=MEMORY_SUMMARY_MAX_TOKENS,
+    )
 
     output_parser = CustomOutputParser()
 
-    llm = ChatOpenAI(temperature=0)
+    # Streamed, so callbacks passed to run() get each token as it is generated
+    llm = ChatOpenAI(temperature=0, streaming=True)
 
     # LLM chain consisting of the LLM and a prompt
     llm_chain = LLMChain(llm=llm, prompt=prompt)
@@ -0,0 +1,151 @@
+"""Benchmark the agent's prompt template and output parser against their original versions.
+
+Simulates an agent run of --steps steps whose observations are --observation-chars characters
+long, formatting the prompt at every step as the agent does. The original template rebuilds the
+scratchpad and tool descriptions at every step; CustomPromptTemplate extends the scratchpad with
+the new step only. Then parses LLM outputs with long thoughts with both parsers. The outputs of
+each pair are checked to be identical.
+
+    python benchmark_agent_prompt.py
+    python benchmark_agent_prompt.py --steps 10 --observation-chars 20000
+"""
+import argparse
+import re
+import time
+
+from langchain.agents import Tool
+from langchain.schema import AgentAction
+
+from assistant import CustomPromptTemplate, CustomOutputParser
+from config import SYSTEM_PROMPT
+
+
+# The original format_messages, which rebuilds everything at every step
+def format_prompt_rebuild(template, tools, **kwargs):
+    intermediate_steps = kwargs.pop("intermediate_steps")
+    thoughts = ""
+    for action, observation in intermediate_steps:
+        thoughts += action.log
+        thoughts += f"\nObservation: {observation}\nThought: "
+    kwargs["agent_scratchpad"] = thoughts
+    kwargs["tools"] = "\n".join([f"{tool.name}: {tool.description}" for tool in tools])
+    kwargs["tool_names"] = ", ".join([tool.name for tool in tools])
+    return template.format(**kwargs)
+
+
+# The original parse, returning (tool, tool input) or the final answer
+def parse_search(llm_output):
+    if "Final Answer:" in llm_output:
+        return llm_output.split("Final Answer:")[-1].strip()
+    regex = r"Action\s*\d*\s*:(.*?)\nAction\s*\d*\s*Input\s*\d*\s*:[\s]*(.*)"
+    match = re.search(regex, llm_output, re.DOTALL)
+    return match.group(1).strip(), match.group(2).strip(" ").strip('"')
+
+
+def parse_fast(parser, llm_output):
+    parsed = parser.parse(llm_output)
+    if isinstance(parsed, AgentAction):
+        return parsed.tool, parsed.tool_input
+    return parsed.return_values["output"]
+
+
+def make_steps(steps, observation_chars):
+    observation = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (
+        observation_chars // 57 + 1
+    ))[:observation_chars]
+    return [
+        (
+            AgentAction(
+                tool="Search",
+                tool_input=f"Question {i}",
+                log=f"I should search.\nAction: Search\nAction Input: Question {i}",
+            ),
+            observation,
+        )
+        for i in range(steps)
+    ]
+
+
+def time_run(format_step, steps, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        # The agent formats the prompt once per step, with the steps taken so far
+        prompts = [format_step(steps[:i]) for i in range(len(steps) + 1)]
+        best = min(best, time.perf_counter() - start)
+    return best, prompts
+
+
+def time_parse(parse, outputs, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parsed = [parse(output) for output in outputs]
+        best = min(best, time.perf_counter() - start)
+    return best, parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--observation-chars", type=int, default=50000)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    tools = [
+        Tool(name=name, func=lambda query: query, description=description)
+        for name, description in [
+            ("Search", "Useful for when you need to answer general knowledge questions."),
+            ("Ask", "Useful if the question is not general knowledge."),
+        ]
+    ]
+    steps = make_steps(args.steps, args.observation_chars)
+    inputs = {"input": "Who won the 2008 championship?", "history": ""}
+
+    prompt = CustomPromptTemplate(
+        template=SYSTEM_PROMPT,
+        tools=tools,
+        input_variables=["input", "intermediate_steps", "history"],
+    )
+    old_seconds, old_prompts = time_run(
+        lambda taken: format_prompt_rebuild(
+            SYSTEM_PROMPT, tools, intermediate_steps=taken, **inputs
+        ),
+        steps,
+        args.repeats,
+    )
+    new_seconds, new_prompts = time_run(
+        lambda taken: prompt.format_messages(intermediate_steps=taken, **inputs)[
+            0
+        ].content,
+        steps,
+        args.repeats,
+    )
+    if new_prompts != old_prompts:
+        raise AssertionError("Prompts differ")
+
+    thought = "I need to think about this carefully. " * (args.observation_chars // 38)
+    outputs = [
+        f"{thought}\nAction: Search\nAction Input: Who won in 2008?",
+        f"{thought}\nAction 1: Ask\nAction 1 Input 1: \"What is F1?\"",
+        f"{thought}\nI now know the final answer\nFinal Answer: Lewis Hamilton",
+    ] * 10
+    output_parser = CustomOutputParser()
+    old_parse_seconds, old_parsed = time_parse(parse_search, outputs, args.repeats)
+    new_parse_seconds, new_parsed = time_parse(
+        lambda output: parse_fast(output_parser, output), outputs, args.repeats
+    )
+    if new_parsed != old_parsed:
+        raise AssertionError("Parsed outputs differ")
+
+    print(f"{'':<40}{'original s':>12}{'new s':>10}{'speedup':>9}")
+    print(
+        f"{f'prompt, {args.steps} steps':<40}{old_seconds:>12.4f}{new_seconds:>10.4f}"
+        f"{old_seconds / new_seconds:>8.1f}x"
+    )
+    print(
+        f"{f'parse, {len(outputs)} outputs':<40}{old_parse_seconds:>12.4f}"
+        f"{new_parse_seconds:>10.4f}{old_parse_seconds / new_parse_seconds:>8.1f}x"
+    )
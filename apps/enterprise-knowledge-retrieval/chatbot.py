@@ -1,21 +1,20 @@
+from collections import deque
+
 from langchain.agents import Tool
-import pandas as pd
 import streamlit as st
 from streamlit_chat import message
 
-from database import get_redis_connection
+from config import RESULTS_LOG_SIZE
 from assistant import (
     answer_user_question,
     initiate_agent,
     answer_question_hyde,
+    answer_question_parallel_hyde,
+    answer_directly,
     ask_gpt,
 )
-
-# Initialise database
-
-## Initialise Redis connection
-redis_client = get_redis_connection()
-
+from tool_cache import cached_tool, new_session_tool_cache
+from streaming import StreamlitAgentHandler
 
 ### CHATBOT APP
 
@@ -30,21 +29,44 @@ st.subheader("Learn things - random things!")
 
 # Using object notation
 add_selectbox = st.sidebar.selectbox(
-    "What kind of search?", ("Standard vector search", "HyDE")
+    "What kind of search?", ("Standard vector search", "HyDE", "Parallel HyDE")
+)
+search_functions = {
+    "Standard vector search": answer_user_question,
+    "HyDE": answer_question_hyde,
+    "Parallel HyDE": answer_question_parallel_hyde,
+}
+stream_steps = st.sidebar.checkbox("Show the agent's steps as it works", value=True)
+route_directly = st.sidebar.checkbox(
+    "Answer simple lookups without the agent", value=True
+)
+
+# Each session keeps its own recent search results in memory
+if "search_results" not in st.session_state:
+    st.session_state["search_results"] = deque(maxlen=RESULTS_LOG_SIZE)
+
+# Tool results are cached per session, in front of a cache shared by all sessions
+if "tool_cache" not in st.session_state:
+    st.session_state["tool_cache"] = new_session_tool_cache()
+
+# Search with the selected kind of search, used by the agent and by the router
+search_tool = cached_tool(
+    search_functions[add_selectbox],
+    add_selectbox,
+    st.session_state["tool_cache"],
+    results_log=st.session_state["search_results"],
 )
 
 # Define which tools the agent can use to answer user queries
 tools = [
     Tool(
         name="Search",
-        func=answer_user_question
-        if add_selectbox == "Standard vector search"
-        else answer_question_hyde,
+        func=search_tool,
         description="Useful for when you need to answer general knowledge questions. Input should be a fully formed question.",
     ),
     Tool(
         name="Ask",
-        func=ask_gpt,
+        func=cached_tool(ask_gpt, "Ask", st.session_state["tool_cache"]),
         description="Useful if the question is not general knowledge. Input should be a fully formed question.",
     ),
 ]
@@ -64,15 +86,34 @@ def query(question):
 prompt = st.text_input("What do you want to know: ", "", key="input")
 
 if st.button("Submit", key="generationSubmit"):
-    with st.spinner("Thinking..."):
-        # Initialization
-        if "agent" not in st.session_state:
-            st.session_state["agent"] = initiate_agent(tools)
-
-        response = st.session_state["agent"].run(prompt)
-
-        st.session_state.past.append(prompt)
-        st.session_state.generated.append(response)
+    # Initialization
+    if "agent" not in st.session_state:
+        st.session_state["agent"] = initiate_agent(tools)
+
+    response = None
+    if route_directly:
+        with st.spinner("Searching..."):
+            response = answer_directly(prompt, search_tool)
+
+    if response is not None:
+        # Keep the agent's memory of the conversation complete for follow-ups
+        st.session_state["agent"].memory.save_context(
+            {"input": prompt}, {"output": response}
+        )
+    elif stream_steps:
+        steps = st.expander("Agent steps", expanded=True)
+        answer = st.empty()
+        response = st.session_state["agent"].run(
+            prompt, callbacks=[StreamlitAgentHandler(steps, answer)]
+        )
+        # The answer is shown with the rest of the conversation below
+        answer.empty()
+    else:
+        with st.spinner("Thinking..."):
+            response = st.session_state["agent"].run(prompt)
+
+    st.session_state.past.append(prompt)
+    st.session_state.generated.append(response)
 
 if len(st.session_state["generated"]) > 0:
     for i in range(len(st.session_state["generated"]) - 1, -1, -1):
@@ -81,6 +122,15 @@ if len(st.session_state["generated"]) > 0:
 
     with st.expander("See search results"):
 
-        results = list(pd.read_csv("results.csv")["result"])
-
-        st.write(results)
+        if st.session_state["search_results"]:
+            _, results = st.session_state["search_results"][-1]
+            st.write(results["result"])
+
+tool_stats = st.session_state["tool_cache"].get_stats()
+if tool_stats:
+    with st.sidebar.expander("Tool calls"):
+        for tool_name, stats in tool_stats.items():
+            st.write(
+                f"{tool_name}: {stats['calls']} calls, {stats['hit_rate']:.0%} cached "
+                f"({stats['session_hits']} this session, {stats['global_hits']} shared)"
+            )
@@ -0,0 +1,83 @@
+"""Split articles into token-bounded chunks that point back to the article they came from.
+
+Each chunk is stored and searched on its own, so a query only brings back the passages that
+matched rather than whole articles. The article itself is stored once under its parent ID, from
+where it can be fetched if a result needs more context than its chunk.
+"""
+import re
+
+from config import CHUNK_TOKENS
+
+# Sentences end at a full stop, question or exclamation mark followed by whitespace,
+# and paragraphs at a line break
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+# Split text into sentences, each keeping the whitespace that follows it
+def split_sentences(text):
+    sentences = []
+    start = 0
+    for boundary in SENTENCE_BOUNDARY.finditer(text):
+        sentences.append(text[start : boundary.end()])
+        start = boundary.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+# Pack whole sentences into chunks of at most chunk_tokens tokens, splitting any sentence
+# that is longer than that on its own
+def chunk_text(text, tokenizer, chunk_tokens=CHUNK_TOKENS):
+    sentences = split_sentences(text)
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence, tokens in zip(sentences, tokenizer.encode_batch(sentences)):
+        if current and current_tokens + len(tokens) > chunk_tokens:
+            chunks.append("".join(current).strip())
+            current, current_tokens = [], 0
+        if len(tokens) > chunk_tokens:
+            for i in range(0, len(tokens), chunk_tokens):
+                chunks.append(tokenizer.decode(tokens[i : i + chunk_tokens]).strip())
+            continue
+        current.append(sentence)
+        current_tokens += len(tokens)
+    if current:
+        chunks.append("".join(current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+def chunk_article(article_id, url, title, text, tokenizer, chunk_tokens=CHUNK_TOKENS):
+    """Split an article into chunk records, and a parent record for the whole article.
+
+    Args:
+        article_id (str): The article's ID, which its chunks refer to as their parent_id.
+        url (str): The article's URL.
+        title (str): The article's title.
+        text (str): The article's text.
+        tokenizer: The tiktoken encoding that chunk sizes are counted in.
+        chunk_tokens (int): Most tokens in a chunk.
+
+    Returns:
+        tuple: The parent record and a list of chunk records, each a dict with an ``id`` and
+        the ``metadata`` to store, in the form load_vectors takes.
+    """
+    parent_id = str(article_id)
+    parent = {
+        "id": parent_id,
+        "metadata": {"url": url, "title": title, "content": text},
+    }
+    chunks = [
+        {
+            "id": f"{parent_id}-{i}",
+            "metadata": {
+                "url": url,
+                "title": title,
+                "content": chunk,
+                "parent_id": parent_id,
+                "file_chunk_index": i,
+            },
+        }
+        for i, chunk in enumerate(chunk_text(text, tokenizer, chunk_tokens))
+    ]
+    return parent, chunks
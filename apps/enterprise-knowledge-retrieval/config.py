@@ -2,7 +2,43 @@ REDIS_HOST = "localhost"
 REDIS_PORT = "6379"
 REDIS_DB = "0"
 INDEX_NAME = "wiki-index"
+PREFIX = "wiki"
 VECTOR_FIELD_NAME = "content_vector"
+# The index's vectors and the settings of its HNSW graph, see the notebook
+VECTOR_DIM = 1536
+DISTANCE_METRIC = "COSINE"
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+# Articles are searched in chunks of at most CHUNK_TOKENS tokens. Whole articles are kept
+# under PARENT_PREFIX, outside the index, and with EXPAND_PARENTS each result's chunk is
+# replaced by the article it came from
+CHUNK_TOKENS = 300
+PARENT_PREFIX = "article"
+EXPAND_PARENTS = False
+# When articles are chunked and embedded, at most EMBEDDING_CONCURRENCY embedding requests
+# run at once however many batches are loading, and a request that fails with a rate
+# limit or server error is retried up to EMBEDDING_MAX_RETRIES times with backoff
+EMBEDDING_CONCURRENCY = 2
+EMBEDDING_MAX_RETRIES = 5
+# Where vectors are stored: "redis" for a RediSearch server, or "numpy" for an in-process
+# store persisted to NUMPY_STORE_PATH, which suits small corpora
+VECTOR_STORE = "redis"
+NUMPY_STORE_PATH = "local_index"
+# How many recent searches each app session keeps the results of
+RESULTS_LOG_SIZE = 5
+# Agent tool results are reused for TOOL_CACHE_TTL_SECONDS, from a cache per session and
+# then from one shared by all sessions
+TOOL_CACHE_TTL_SECONDS = 3600
+TOOL_CACHE_SESSION_SIZE = 64
+TOOL_CACHE_GLOBAL_SIZE = 1024
+# Questions whose best search result is within this cosine distance are answered from the
+# search directly rather than by the agent. Lower it if off-topic questions get through
+ROUTER_MAX_DISTANCE = 0.15
+# Most tokens of recent conversation the agent's memory keeps word for word, beyond which
+# older turns are summarised
+MEMORY_MAX_TOKENS = 1000
+# Most of MEMORY_MAX_TOKENS the summary of older turns may take up
+MEMORY_SUMMARY_MAX_TOKENS = 250
 CHAT_MODEL = "gpt-3.5-turbo"
 EMBEDDINGS_MODEL = "text-embedding-ada-002"
 # Set up the base template
@@ -30,6 +66,10 @@ Previous conversation history:
 
 New question: {input}
 {agent_scratchpad}"""
+# Most tokens of search results put into RETRIEVAL_PROMPT, and how similar two results may be,
+# as the overlap of their three word sequences, before the second is left out
+CONTEXT_TOKEN_BUDGET = 1500
+CONTEXT_DUPLICATE_SIMILARITY = 0.8
 # Build a prompt to provide the original query, the result and ask to summarise for the user
 RETRIEVAL_PROMPT = """Use the content to answer the search query the customer has sent. Provide the source for your answer.
 If you can't answer the user's question, say "Sorry, I am unable to answer the question with the content". Do not guess.
@@ -44,3 +84,16 @@ Content:
 
 Answer:
 """
+# Ask for a hypothetical answer to search with, see HyDE (https://arxiv.org/abs/2212.10496)
+HYDE_PROMPT = """You are OracleGPT, an helpful expert who answers user questions to the best of their ability.
+    Provide a confident answer to their question. If you don't know the answer, make the best guess you can based on the context of the question.
+
+    User question: {USER_QUESTION_HERE}
+    
+    Answer:"""
+# Parallel HyDE streams the hypothetical answer, capped at HYDE_MAX_TOKENS, and stops reading
+# it at the first sentence end after HYDE_MIN_CHARS characters, which is enough to search with
+HYDE_MAX_TOKENS = 150
+HYDE_MIN_CHARS = 300
+# The k of reciprocal rank fusion, which damps the weight of the top few ranks
+RRF_K = 60
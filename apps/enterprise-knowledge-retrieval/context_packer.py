@@ -0,0 +1,97 @@
+"""Pack search results into the content of RETRIEVAL_PROMPT within a token budget.
+
+Wikipedia articles vary from a few sentences to tens of thousands of tokens, so pasting whole
+results into the prompt makes its size, and the latency of the answer, depend on which articles
+were found. pack_context adds results in score order until the budget is used up, cutting the
+last one at a sentence end where it can and skipping passages that nearly repeat one already
+added.
+"""
+import re
+from functools import lru_cache
+
+import tiktoken
+
+from config import CHAT_MODEL, CONTEXT_TOKEN_BUDGET, CONTEXT_DUPLICATE_SIMILARITY
+
+# A token is rarely longer than this many characters, so longer passages can be cut to
+# budget * MAX_CHARS_PER_TOKEN characters before they are encoded
+MAX_CHARS_PER_TOKEN = 10
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*(?=\s|$)")
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model=CHAT_MODEL):
+    return tiktoken.encoding_for_model(model)
+
+
+# Overlapping three word sequences, to compare passages by
+def get_shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i : i + 3]) for i in range(max(len(words) - 2, 1))}
+
+
+def is_near_duplicate(
+    shingles, packed_shingles, threshold=CONTEXT_DUPLICATE_SIMILARITY
+):
+    for other in packed_shingles:
+        overlap = len(shingles & other) / len(shingles | other)
+        if overlap >= threshold:
+            return True
+    return False
+
+
+# Cut text to at most max_tokens tokens, ending at the last whole sentence that fits, or
+# at max_tokens if not even one sentence fits. Returns the text and its token count
+def truncate_to_sentence(text, max_tokens, tokenizer):
+    max_chars = max_tokens * MAX_CHARS_PER_TOKEN
+    tokens = tokenizer.encode(text[:max_chars])
+    if len(tokens) <= max_tokens and len(text) <= max_chars:
+        return text, len(tokens)
+    truncated = tokenizer.decode(tokens[:max_tokens])
+    sentence_ends = list(SENTENCE_END.finditer(truncated))
+    if not sentence_ends:
+        # A cut inside a character decodes to a replacement character, which is dropped
+        truncated = truncated.rstrip("\ufffd")
+        return truncated, len(tokenizer.encode(truncated))
+    truncated = truncated[: sentence_ends[-1].end()]
+    return truncated, len(tokenizer.encode(truncated))
+
+
+def pack_context(results, token_budget=CONTEXT_TOKEN_BUDGET, model=CHAT_MODEL):
+    """Build the content for RETRIEVAL_PROMPT from the best results that fit the budget.
+
+    Args:
+        results (SearchResults): Search results, best first.
+        token_budget (int): Most tokens the content may use.
+        model (str): The model whose tokenizer counts the tokens.
+
+    Returns:
+        str: The title and text of each result used, separated by blank lines.
+    """
+    tokenizer = get_tokenizer(model)
+    remaining = token_budget
+    packed_shingles = []
+    search_content = ""
+    for result in results:
+        shingles = get_shingles(result.result)
+        if is_near_duplicate(shingles, packed_shingles):
+            continue
+
+        header = result.title + "\n"
+        # The header and the blank line after the passage
+        overhead = len(tokenizer.encode(header)) + 1
+        if remaining - overhead <= 0:
+            break
+        passage, passage_tokens = truncate_to_sentence(
+            result.result, remaining - overhead, tokenizer
+        )
+        if not passage:
+            continue
+
+        search_content += header + passage + "\n\n"
+        packed_shingles.append(shingles)
+        remaining -= overhead + passage_tokens
+        if passage != result.result:
+            # The budget is used up
+            break
+    return search_content
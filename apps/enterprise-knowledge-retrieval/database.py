@@ -1,9 +1,11 @@
 import ast
 from math import isnan
+from typing import NamedTuple, Optional
 import numpy as np
-import pandas as pd
 import openai
 from redis import Redis as r
+from redis.commands.search.field import NumericField, TagField, TextField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search.query import Query
 
 from config import (
@@ -13,7 +15,18 @@ from config import (
     VECTOR_FIELD_NAME,
     EMBEDDINGS_MODEL,
     INDEX_NAME,
+    PREFIX,
+    VECTOR_STORE,
+    NUMPY_STORE_PATH,
+    RRF_K,
+    PARENT_PREFIX,
+    EXPAND_PARENTS,
+    VECTOR_DIM,
+    DISTANCE_METRIC,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
 )
+from vector_store import VectorStore, NumpyVectorStore
 
 
 def get_redis_connection():
@@ -23,6 +36,104 @@ def get_redis_connection():
     return redis_client
 
 
+# Get the vector store selected in config, either a Redis connection or an in-process store
+def get_vector_store(store_type=VECTOR_STORE):
+    if store_type == "redis":
+        return get_redis_connection()
+    if store_type == "numpy":
+        return NumpyVectorStore(NUMPY_STORE_PATH)
+    raise ValueError(f"Unsupported vector store: {store_type}")
+
+
+# Create the wiki index with an HNSW vector field, over every hash under PREFIX
+def create_index(
+    redis_conn,
+    index_name=INDEX_NAME,
+    m=HNSW_M,
+    ef_construction=HNSW_EF_CONSTRUCTION,
+    initial_cap=None,
+):
+    vector_params = {
+        "TYPE": "FLOAT32",
+        "DIM": VECTOR_DIM,
+        "DISTANCE_METRIC": DISTANCE_METRIC,
+        "M": m,
+        "EF_CONSTRUCTION": ef_construction,
+    }
+    if initial_cap:
+        vector_params["INITIAL_CAP"] = initial_cap
+    fields = [
+        TextField("url"),
+        TextField("title"),
+        TextField("content"),
+        NumericField("file_chunk_index"),
+        TagField("parent_id"),
+        VectorField(VECTOR_FIELD_NAME, "HNSW", vector_params),
+    ]
+    redis_conn.ft(index_name).create_index(
+        fields=fields,
+        definition=IndexDefinition(prefix=[f"{PREFIX}:"], index_type=IndexType.HASH),
+    )
+
+
+# Load vectors and their metadata, using a Redis pipeline unless a local store is in use
+def load_vectors(client, input_list, vector_field_name=VECTOR_FIELD_NAME):
+    if isinstance(client, VectorStore):
+        client.add(
+            [f"{PREFIX}:{text['id']}" for text in input_list],
+            [text["embedding"] for text in input_list],
+            [text["metadata"] for text in input_list],
+        )
+        return
+
+    p = client.pipeline(transaction=False)
+    for text in input_list:
+        # hash key
+        key = f"{PREFIX}:{text['id']}"
+
+        # hash values
+        item_metadata = dict(text["metadata"])
+        item_metadata[vector_field_name] = np.array(
+            text["embedding"], dtype=np.float32
+        ).tobytes()
+
+        # HSET
+        p.hset(key, mapping=item_metadata)
+
+    p.execute()
+
+
+# Store whole articles for parent expansion. In Redis they are plain hashes outside the
+# index's prefix, so they are never searched. A local store needs a vector for every
+# record, so there each parent carries one, e.g. the mean of its chunks' vectors
+def load_parents(client, parents):
+    if isinstance(client, VectorStore):
+        client.collection("articles").add(
+            [f"{PARENT_PREFIX}:{parent['id']}" for parent in parents],
+            [parent["embedding"] for parent in parents],
+            [parent["metadata"] for parent in parents],
+        )
+        return
+
+    p = client.pipeline(transaction=False)
+    for parent in parents:
+        p.hset(f"{PARENT_PREFIX}:{parent['id']}", mapping=parent["metadata"])
+    p.execute()
+
+
+# Get the full content of each parent article, or None for any that aren't stored
+def get_parent_contents(client, parent_ids):
+    keys = [f"{PARENT_PREFIX}:{parent_id}" for parent_id in parent_ids]
+    if isinstance(client, VectorStore):
+        metadata = client.collection("articles").get_metadata(keys)
+        return [item and item["content"] for item in metadata]
+
+    p = client.pipeline(transaction=False)
+    for key in keys:
+        p.hget(key, "content")
+    return [content and content.decode("utf-8") for content in p.execute()]
+
+
 # Make query to Redis
 def query_redis(redis_conn, query, index_name, top_k=5):
 
@@ -32,17 +143,29 @@ def query_redis(redis_conn, query, index_name, top_k=5):
             0
         ]["embedding"],
         dtype=np.float32,
-    ).tobytes()
+    )
+
+    # Only the matching chunk and its metadata are returned, never the whole article
+    return_fields = (
+        "vector_score",
+        "url",
+        "title",
+        "content",
+        "parent_id",
+        "file_chunk_index",
+    )
+    if isinstance(redis_conn, VectorStore):
+        return redis_conn.search(embedded_query, top_k, return_fields=return_fields)
 
     # prepare the query
     q = (
         Query(f"*=>[KNN {top_k} @{VECTOR_FIELD_NAME} $vec_param AS vector_score]")
         .sort_by("vector_score")
         .paging(0, top_k)
-        .return_fields("vector_score", "url", "title", "content", "text_chunk_index")
+        .return_fields(*return_fields)
         .dialect(2)
     )
-    params_dict = {"vec_param": embedded_query}
+    params_dict = {"vec_param": embedded_query.tobytes()}
 
     # Execute the query
     results = redis_conn.ft(index_name).search(q, query_params=params_dict)
@@ -50,23 +173,90 @@ def query_redis(redis_conn, query, index_name, top_k=5):
     return results
 
 
-# Get mapped documents from Redis results
-def get_redis_results(redis_conn, query, index_name):
+# A single search hit returned by get_redis_results
+class SearchResult(NamedTuple):
+    id: int
+    url: str
+    title: str
+    result: str
+    certainty: float
+    # The article the result is a chunk of, if it was loaded in chunks
+    parent_id: Optional[str] = None
+
+
+# A lightweight list of search hits; pandas is only imported if a DataFrame is asked for
+class SearchResults(list):
+    __slots__ = ()
+
+    columns = list(SearchResult._fields)
+
+    # Column-style access so existing results["result"][0] lookups keep working
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return [getattr(result, key) for result in self]
+        return super().__getitem__(key)
+
+    def to_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(list(self), columns=self.columns)
+
+
+# Get mapped documents from Redis results, optionally replacing each chunk with the
+# whole article it came from
+def get_redis_results(redis_conn, query, index_name, expand_parents=EXPAND_PARENTS):
 
     # Get most relevant documents from Redis
     query_result = query_redis(redis_conn, query, index_name)
 
-    # Extract info into a list
-    query_result_list = []
-    for i, result in enumerate(query_result.docs):
-        result_order = i
-        url = result.url
-        title = result.title
-        text = result.content
-        score = result.vector_score
-        query_result_list.append((result_order, url, title, text, score))
-
-    # Display result as a DataFrame for ease of us
-    result_df = pd.DataFrame(query_result_list)
-    result_df.columns = ["id", "url", "title", "result", "certainty"]
-    return result_df
+    # Extract info into a list of typed results
+    results = SearchResults(
+        SearchResult(
+            i,
+            result.url,
+            result.title,
+            result.content,
+            float(result.vector_score),
+            getattr(result, "parent_id", None),
+        )
+        for i, result in enumerate(query_result.docs)
+    )
+    if expand_parents:
+        return expand_to_parents(redis_conn, results)
+    return results
+
+
+# Replace chunks with the articles they came from, keeping each article once at the
+# rank of its best chunk
+def expand_to_parents(client, results):
+    parent_ids = list(
+        dict.fromkeys(result.parent_id for result in results if result.parent_id)
+    )
+    contents = dict(zip(parent_ids, get_parent_contents(client, parent_ids)))
+
+    expanded = SearchResults()
+    seen = set()
+    for result in results:
+        if result.parent_id in seen:
+            continue
+        if result.parent_id:
+            seen.add(result.parent_id)
+        content = contents.get(result.parent_id) or result.result
+        expanded.append(result._replace(id=len(expanded), result=content))
+    return expanded
+
+
+# Merge ranked result lists with reciprocal rank fusion: each hit scores 1 / (k + rank)
+# in every list it appears in, so hits ranked well by several searches come first
+def fuse_results(*result_lists, k=RRF_K):
+    scores = {}
+    hits = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            key = (result.url, result.result)
+            scores[key] = scores.get(key, 0) + 1 / (k + rank)
+            # Keep the closest vector score seen for the hit
+            if key not in hits or result.certainty < hits[key].certainty:
+                hits[key] = result
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return SearchResults(hits[key]._replace(id=i) for i, key in enumerate(ranked))
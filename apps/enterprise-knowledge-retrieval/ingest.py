@@ -0,0 +1,287 @@
+"""Load Wikipedia articles into the wiki index.
+
+From the command line, streams an article CSV such as the notebook's
+vector_database_wikipedia_articles_embedded.csv (id, url, title, text and content_vector
+columns) into the index, creating it first if needed. Rows are read and parsed in batches
+that are loaded by parallel Redis pipelines, so memory use stays constant however large the
+file is. By default each article is stored whole with its precomputed vector; with --chunk
+articles are split into chunks with parent IDs and the chunks are embedded.
+
+    python ingest.py vector_database_wikipedia_articles_embedded.csv
+    python ingest.py wikipedia_articles_2000.csv --chunk --workers 4
+
+From Python:
+
+    from ingest import load_articles
+
+    store = get_vector_store()
+    load_articles(store, [{"id": "1", "url": ..., "title": ..., "text": ...}])
+    store.save()  # only for the local numpy store
+"""
+import argparse
+import csv
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+from itertools import islice
+
+import numpy as np
+import openai
+import tiktoken
+from redis.exceptions import ResponseError
+
+from config import (
+    CHAT_MODEL,
+    CHUNK_TOKENS,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_MAX_RETRIES,
+    EMBEDDINGS_MODEL,
+    INDEX_NAME,
+    VECTOR_DIM,
+    HNSW_M,
+    HNSW_EF_CONSTRUCTION,
+)
+from chunking import chunk_article
+from database import create_index, get_vector_store, load_parents, load_vectors
+from vector_store import VectorStore
+
+# Most inputs, and most tokens, the embeddings endpoint takes in one request
+EMBEDDING_BATCH_MAX_INPUTS = 2048
+EMBEDDING_BATCH_MAX_TOKENS = 300000
+# Failures that are worth waiting out: rate limits, timeouts and server errors
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+# Shared by every batch, so parallel workers can't exceed the rate limit between them
+embedding_slots = threading.BoundedSemaphore(EMBEDDING_CONCURRENCY)
+
+
+def get_embeddings(inputs, max_retries=EMBEDDING_MAX_RETRIES, base_delay=1):
+    for attempt in range(max_retries + 1):
+        try:
+            with embedding_slots:
+                response = openai.Embedding.create(
+                    input=inputs, model=EMBEDDINGS_MODEL
+                )["data"]
+            return [
+                data["embedding"] for data in sorted(response, key=lambda d: d["index"])
+            ]
+        except RETRYABLE_ERRORS:
+            if attempt == max_retries:
+                raise
+            # Exponential backoff, with jitter so that workers don't retry in step
+            time.sleep(base_delay * 2**attempt * (1 + random.random()))
+
+
+# Split inputs into batches that fit in one embeddings request, by input count and by
+# tokens, as (start, end) index ranges
+def get_embedding_batches(
+    token_counts,
+    max_inputs=EMBEDDING_BATCH_MAX_INPUTS,
+    max_tokens=EMBEDDING_BATCH_MAX_TOKENS,
+):
+    start = batch_tokens = 0
+    for i, tokens in enumerate(token_counts):
+        if i > start and (
+            i - start >= max_inputs or batch_tokens + tokens > max_tokens
+        ):
+            yield start, i
+            start, batch_tokens = i, 0
+        batch_tokens += tokens
+    if start < len(token_counts):
+        yield start, len(token_counts)
+
+
+# Chunk, embed and store articles, each a dict with an id, url, title and text
+def load_articles(client, articles, chunk_tokens=CHUNK_TOKENS):
+    tokenizer = tiktoken.encoding_for_model(CHAT_MODEL)
+    parents = []
+    chunks = []
+    for article in articles:
+        parent, article_chunks = chunk_article(
+            article["id"],
+            article["url"],
+            article["title"],
+            article["text"],
+            tokenizer,
+            chunk_tokens,
+        )
+        parents.append(parent)
+        chunks.extend(article_chunks)
+
+    # Chunks are embedded with their article's title, as they are searched without it
+    inputs = [
+        f"Title: {chunk['metadata']['title']};\n{chunk['metadata']['content']}"
+        for chunk in chunks
+    ]
+    token_counts = [len(tokenizer.encode(text)) for text in inputs]
+    for start, end in get_embedding_batches(token_counts):
+        embeddings = get_embeddings(inputs[start:end])
+        for chunk, embedding in zip(chunks[start:end], embeddings):
+            chunk["embedding"] = embedding
+    load_vectors(client, chunks)
+
+    # A parent's vector is the mean of its chunks' vectors
+    chunk_embeddings = {}
+    for chunk in chunks:
+        chunk_embeddings.setdefault(chunk["metadata"]["parent_id"], []).append(
+            chunk["embedding"]
+        )
+    for parent in parents:
+        if parent["id"] in chunk_embeddings:
+            parent["embedding"] = np.mean(chunk_embeddings[parent["id"]], axis=0)
+    load_parents(client, [parent for parent in parents if "embedding" in parent])
+    return len(chunks)
+
+
+# Parse a vector written as "[0.1, -0.2, ...]" straight into float32, which is far
+# quicker than literal_eval building a list of Python floats. fromstring stops quietly
+# at anything it can't parse, so a malformed vector shows up as one of the wrong length
+def parse_vector(text, dim=VECTOR_DIM):
+    vector = np.fromstring(text.strip("[]"), sep=",", dtype=np.float32)
+    if len(vector) != dim:
+        raise ValueError(f"expected a vector of {dim} values, got {len(vector)}")
+    return vector
+
+
+# Store articles whole, with the vectors they were read with. Articles whose vector
+# can't be parsed are reported and skipped, as Redis would skip them without a word
+def load_embedded_articles(client, articles, vector_column):
+    records = []
+    for article in articles:
+        try:
+            embedding = parse_vector(article[vector_column])
+        except ValueError as e:
+            print(f"\nSkipping article {article['id']}: {e}")
+            continue
+        records.append(
+            {
+                "id": f"{article['id']}-0",
+                "embedding": embedding,
+                "metadata": {
+                    "url": article["url"],
+                    "title": article["title"],
+                    "content": article["text"],
+                    "parent_id": str(article["id"]),
+                    "file_chunk_index": 0,
+                },
+            }
+        )
+    load_vectors(client, records)
+    return len(records)
+
+
+def read_batches(path, batch_size):
+    # Article texts are longer than the csv module's default field limit
+    csv.field_size_limit(sys.maxsize)
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        while True:
+            batch = list(islice(reader, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def ensure_index(client, index_name, m, ef_construction):
+    try:
+        client.ft(index_name).info()
+        print(f"Loading into the existing index {index_name}")
+    except ResponseError:
+        create_index(client, index_name, m=m, ef_construction=ef_construction)
+        print(f"Created the index {index_name}")
+
+
+def ingest(path, client, load_batch, batch_size, workers):
+    """Load an article CSV batch by batch, with up to ``workers`` batches loading at once.
+
+    A batch that fails is reported and counted, and the rest of the file is still loaded.
+
+    Returns:
+        tuple: The number of articles read, the number of records stored and the number
+        of articles in batches that failed.
+    """
+    articles = records = failed = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        batches = read_batches(path, batch_size)
+        while True:
+            # Keep at most two batches per worker in memory
+            for batch in islice(batches, 2 * workers - len(pending)):
+                pending[executor.submit(load_batch, client, batch)] = len(batch)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch_articles = pending.pop(future)
+                articles += batch_articles
+                try:
+                    records += future.result()
+                except Exception as e:
+                    failed += batch_articles
+                    print(f"\nFailed to load a batch of {batch_articles} articles: {e}")
+            elapsed = time.perf_counter() - start
+            print(
+                f"\r{articles} articles, {records} records, {failed} failed in "
+                f"{elapsed:.0f}s ({articles / elapsed:.0f} articles/s, "
+                f"{records / elapsed:.0f} records/s)",
+                end="",
+                flush=True,
+            )
+    print()
+    return articles, records, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("csv_file")
+    parser.add_argument("--index-name", default=INDEX_NAME)
+    parser.add_argument("--vector-column", default="content_vector")
+    parser.add_argument(
+        "--chunk",
+        action="store_true",
+        help="Split articles into chunks and embed them, rather than loading "
+        "the vectors in the file",
+    )
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--m", type=int, default=HNSW_M, help="HNSW M")
+    parser.add_argument(
+        "--ef-construction",
+        type=int,
+        default=HNSW_EF_CONSTRUCTION,
+        help="HNSW EF_CONSTRUCTION",
+    )
+    args = parser.parse_args()
+
+    client = get_vector_store()
+    if not isinstance(client, VectorStore):
+        ensure_index(client, args.index_name, args.m, args.ef_construction)
+
+    if args.chunk:
+        load_batch = partial(load_articles, chunk_tokens=args.chunk_tokens)
+    else:
+        load_batch = partial(load_embedded_articles, vector_column=args.vector_column)
+    start = time.perf_counter()
+    articles, records, failed = ingest(
+        args.csv_file, client, load_batch, args.batch_size, args.workers
+    )
+    if isinstance(client, VectorStore):
+        # Written once at the end, along with the articles collection
+        client.save()
+    print(
+        f"Loaded {records} records from {articles} articles in "
+        f"{time.perf_counter() - start:.1f}s, {failed} articles failed"
+    )
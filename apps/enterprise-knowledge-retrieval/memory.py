@@ -0,0 +1,71 @@
+"""Conversation memory for the agent, kept within a token budget.
+
+A window of the last k turns bounds how many turns go into the agent's prompt but not how long
+they are, and long answers make every later prompt longer. TokenBudgetMemory keeps the most
+recent turns word for word while they fit the budget, and folds older turns into a running
+summary, so the history part of the prompt stays about the same size however long the
+conversation gets.
+"""
+from typing import List, Optional
+
+from langchain.memory import ConversationSummaryBufferMemory
+
+from context_packer import get_tokenizer, truncate_to_sentence
+
+# The "Human: " or "AI: " prefix and line break each message gets in the prompt
+TOKENS_PER_MESSAGE = 4
+
+
+class TokenBudgetMemory(ConversationSummaryBufferMemory):
+    """Recent turns verbatim and a summary of the rest, within ``max_token_limit`` tokens.
+
+    ConversationSummaryBufferMemory recounts the tokens of the whole buffer after every turn,
+    and again after each message it drops. Here each message is counted once, when it is
+    added, and a running total is kept. Whole turns are dropped, oldest first, and only the
+    dropped turns are summarised, into the existing summary, by ``llm``.
+
+    The summary counts against the limit too. It is cut to ``max_summary_tokens``, a quarter
+    of the limit by default, and when turns are dropped enough go for the recent turns and
+    the new summary to fit together.
+    """
+
+    max_summary_tokens: Optional[int] = None
+    # Token counts of chat_memory.messages, in the same order, and their total
+    message_tokens: List[int] = []
+    buffer_tokens: int = 0
+    summary_tokens: int = 0
+
+    def count_tokens(self, message):
+        return TOKENS_PER_MESSAGE + len(get_tokenizer().encode(message.content))
+
+    def prune(self) -> None:
+        messages = self.chat_memory.messages
+        # Count the messages added since the last time
+        for message in messages[len(self.message_tokens) :]:
+            tokens = self.count_tokens(message)
+            self.message_tokens.append(tokens)
+            self.buffer_tokens += tokens
+        if self.buffer_tokens + self.summary_tokens <= self.max_token_limit:
+            return
+
+        # Leave room for the longest summary, so it needn't be made again this turn
+        summary_limit = self.max_summary_tokens or self.max_token_limit // 4
+        pruned_memory = []
+        while messages and (
+            self.buffer_tokens > self.max_token_limit - summary_limit
+            # Don't leave an answer without its question
+            or messages[0].type == "ai"
+        ):
+            pruned_memory.append(messages.pop(0))
+            self.buffer_tokens -= self.message_tokens.pop(0)
+        summary = self.predict_new_summary(pruned_memory, self.moving_summary_buffer)
+        self.moving_summary_buffer, tokens = truncate_to_sentence(
+            summary, summary_limit - TOKENS_PER_MESSAGE, get_tokenizer()
+        )
+        self.summary_tokens = TOKENS_PER_MESSAGE + tokens
+
+    def clear(self) -> None:
+        super().clear()
+        self.message_tokens = []
+        self.buffer_tokens = 0
+        self.summary_tokens = 0
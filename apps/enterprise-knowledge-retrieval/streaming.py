@@ -0,0 +1,45 @@
+"""Show the agent's work in the app while it runs.
+
+The agent takes several LLM calls and tool calls to answer a question. Rather than leaving the
+user behind a spinner until it is done, StreamlitAgentHandler renders each Thought/Action as its
+tokens arrive, each tool's Observation as it returns, and the final answer token by token.
+"""
+from langchain.callbacks.base import BaseCallbackHandler
+
+FINAL_ANSWER = "Final Answer:"
+
+
+class StreamlitAgentHandler(BaseCallbackHandler):
+    """Callbacks that write an agent's steps and answer to Streamlit elements.
+
+    The agent's LLM must be created with ``streaming=True`` for tokens to arrive one by one.
+
+    Args:
+        steps_container: The Streamlit container to write each step to.
+        answer_placeholder: An ``st.empty()`` placeholder to write the final answer to.
+    """
+
+    def __init__(self, steps_container, answer_placeholder):
+        self.steps_container = steps_container
+        self.answer_placeholder = answer_placeholder
+        self.text = ""
+        self.step = None
+
+    # Each LLM call of the agent is a new step
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.text = ""
+        self.step = self.steps_container.empty()
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.text += token
+        thought, final_answer, answer = self.text.partition(FINAL_ANSWER)
+        # Markdown needs two trailing spaces to keep a line break
+        self.step.markdown(thought.replace("\n", "  \n"))
+        if final_answer:
+            self.answer_placeholder.markdown(answer.strip() + "▌")
+
+    def on_tool_end(self, output, **kwargs):
+        self.steps_container.markdown(f"**Observation:** {output}")
+
+    def on_agent_finish(self, finish, **kwargs):
+        self.answer_placeholder.markdown(finish.return_values["output"])
@@ -0,0 +1,126 @@
+"""Memoised agent tools.
+
+Within one question the agent often calls the same tool again with the same or nearly the same
+input, and different sessions ask the same questions, each call paying for an embedding, a KNN
+search and a completion. cached_tool wraps a tool function so that its results are reused from a
+per-session cache, then from a cache shared by every session, before the function is called.
+The search results a tool logs are cached with its answer, and logged again whenever the answer
+is reused.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from config import (
+    TOOL_CACHE_TTL_SECONDS,
+    TOOL_CACHE_SESSION_SIZE,
+    TOOL_CACHE_GLOBAL_SIZE,
+)
+
+
+# Inputs that differ only in case, spacing, quoting or closing punctuation are the same input
+def normalize_tool_input(tool_input):
+    return " ".join(tool_input.lower().split()).strip("\"'").rstrip("?.! ")
+
+
+class ToolCache:
+    """A least recently used cache of tool results that expire after ``ttl_seconds``.
+
+    Also counts the calls made to each tool through it and how many were answered from the
+    cache.
+
+    Args:
+        max_entries (int): Most results kept.
+        ttl_seconds (float): How long a result is reused for.
+    """
+
+    def __init__(self, max_entries, ttl_seconds=TOOL_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        # (tool name, normalised input) -> (time cached, result), least recently used first
+        self.entries = OrderedDict()
+        self.stats = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, result):
+        with self.lock:
+            self.entries[key] = (time.time(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def record(self, tool_name, outcome):
+        with self.lock:
+            stats = self.stats.setdefault(
+                tool_name, {"calls": 0, "session_hits": 0, "global_hits": 0}
+            )
+            stats["calls"] += 1
+            if outcome in stats:
+                stats[outcome] += 1
+
+    # Calls and hit rates per tool, for display
+    def get_stats(self):
+        with self.lock:
+            return {
+                tool_name: dict(
+                    stats,
+                    hit_rate=(stats["session_hits"] + stats["global_hits"])
+                    / stats["calls"],
+                )
+                for tool_name, stats in self.stats.items()
+            }
+
+
+# Results shared by every session of the app
+global_tool_cache = ToolCache(TOOL_CACHE_GLOBAL_SIZE)
+
+
+def new_session_tool_cache():
+    return ToolCache(TOOL_CACHE_SESSION_SIZE)
+
+
+# Wrap a tool function to look its input up in the session's cache, then the global cache,
+# before calling it. Calls are counted in the session cache's stats. With a results_log,
+# func is called with a results_log of its own, and what it logs is added to results_log
+# on every call, whether the answer came from a cache or not
+def cached_tool(
+    func, tool_name, session_cache, shared_cache=global_tool_cache, results_log=None
+):
+    def cached_func(tool_input):
+        key = (tool_name, normalize_tool_input(tool_input))
+
+        # Entries are (answer, logged results) pairs
+        entry = session_cache.get(key)
+        if entry is not None:
+            session_cache.record(tool_name, "session_hits")
+        else:
+            entry = shared_cache.get(key)
+            if entry is not None:
+                session_cache.record(tool_name, "global_hits")
+            else:
+                session_cache.record(tool_name, "misses")
+                if results_log is None:
+                    entry = (func(tool_input), [])
+                else:
+                    logged = []
+                    entry = (func(tool_input, results_log=logged), logged)
+                shared_cache.set(key, entry)
+            session_cache.set(key, entry)
+
+        answer, logged = entry
+        if results_log is not None:
+            results_log.extend(logged)
+        return answer
+
+    return cached_func
@@ -0,0 +1,262 @@
+"""In-process vector stores that can stand in for Redis behind query_redis and
+load_vectors.
+
+For small corpora (a few thousand chunks) a brute-force search over a normalised
+float32 matrix takes well under a millisecond, which is cheaper than a network round
+trip to Redis.
+"""
+import functools
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+# Serialise access to a store shared between threads, e.g. by an ingestion pipeline
+def locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# Mirrors a redis-py search Document so callers can treat results the same way
+class Document:
+    def __init__(self, id, **fields):
+        self.id = id
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return f"Document {self.__dict__}"
+
+
+# Mirrors the shape of a redis-py search Result
+class Result:
+    def __init__(self, docs):
+        self.docs = docs
+        self.total = len(docs)
+
+
+# Check one row's metadata against search filters, with the same rules as the
+# RediSearch prefilter: a str matches if every word appears in the field, a number is
+# an exact match, a (min, max) tuple is an inclusive range and a list matches any of
+# its values
+def matches_filter(field_value, value):
+    if isinstance(value, list):
+        return any(matches_filter(field_value, item) for item in value)
+    if field_value is None:
+        return False
+    if isinstance(value, tuple):
+        low, high = value
+        return low <= float(field_value) <= high
+    if isinstance(value, (int, float)):
+        return float(field_value) == value
+    field_text = str(field_value).lower()
+    return all(term in field_text for term in str(value).lower().split())
+
+
+def matches_filters(metadata, filters):
+    return all(
+        matches_filter(metadata.get(field), value) for field, value in filters.items()
+    )
+
+
+# The interface a vector store must provide to be used in place of a Redis connection
+class VectorStore(ABC):
+
+    # Add or replace vectors and their metadata under the given keys
+    @abstractmethod
+    def add(self, keys, vectors, metadata):
+        ...
+
+    # Return the top_k nearest documents to an embedded query, scored by cosine
+    # distance, optionally only considering documents whose metadata matches the filters
+    @abstractmethod
+    def search(self, embedded_query, top_k, return_fields=None, filters=None):
+        ...
+
+    # Return the stored metadata for each key, or None for keys that aren't stored
+    @abstractmethod
+    def get_metadata(self, keys):
+        ...
+
+    # A separate store of the same kind for another kind of record, such as whole-document vectors,
+    # so that searches of one never return the other
+    @abstractmethod
+    def collection(self, name):
+        ...
+
+
+class NumpyVectorStore(VectorStore):
+    """Brute-force cosine similarity search over a normalised float32 matrix.
+
+    Args:
+        path (str): Optional directory to persist the store to. Vectors are saved as
+            ``vectors.npy`` and memory-mapped on load, metadata is saved as
+            ``metadata.json``.
+        autosave (bool): Whether to write the store to ``path`` after every change.
+            Each save rewrites the whole store, so loaders leave this off and call
+            ``save`` once per batch or run.
+    """
+
+    VECTORS_FILE = "vectors.npy"
+    METADATA_FILE = "metadata.json"
+
+    def __init__(self, path=None, autosave=False):
+        self.path = path
+        self.autosave = autosave
+        self._matrix = None
+        self._size = 0
+        self._keys = []
+        self._metadata = []
+        self._key_index = {}
+        self._collections = {}
+        self._lock = threading.RLock()
+        if path and os.path.exists(os.path.join(path, self.VECTORS_FILE)):
+            self.load()
+
+    def __len__(self):
+        return self._size
+
+    # Rows of the matrix currently in use
+    @property
+    def vectors(self):
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._matrix[: self._size]
+
+    # Make sure the matrix is writable and has room for `extra` more rows
+    def _reserve(self, extra, dimensions):
+        # An empty store, including one saved empty and reloaded, takes any dimension
+        if self._matrix is None or not self._size:
+            self._matrix = np.empty((max(extra, 16), dimensions), dtype=np.float32)
+            return
+        if self._matrix.shape[1] != dimensions:
+            raise ValueError(
+                f"Expected vectors of dimension {self._matrix.shape[1]}, "
+                f"got {dimensions}"
+            )
+        needed = self._size + extra
+        # A memory-mapped matrix is read-only, so the first write copies it into memory
+        if needed > self._matrix.shape[0] or isinstance(self._matrix, np.memmap):
+            capacity = max(needed, 2 * self._matrix.shape[0])
+            matrix = np.empty((capacity, dimensions), dtype=np.float32)
+            matrix[: self._size] = self._matrix[: self._size]
+            self._matrix = matrix
+
+    @locked
+    def add(self, keys, vectors, metadata):
+        if not len(keys):
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(keys), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        self._reserve(len(keys), vectors.shape[1])
+        for key, vector, item_metadata in zip(keys, vectors, metadata):
+            row = self._key_index.get(key)
+            if row is None:
+                row = self._size
+                self._size += 1
+                self._key_index[key] = row
+                self._keys.append(key)
+                self._metadata.append(dict(item_metadata))
+            else:
+                self._metadata[row] = dict(item_metadata)
+            self._matrix[row] = vector
+
+        if self.autosave and self.path:
+            self.save()
+
+    @locked
+    def get_metadata(self, keys):
+        rows = [self._key_index.get(key) for key in keys]
+        return [None if row is None else dict(self._metadata[row]) for row in rows]
+
+    # Collections are kept in subdirectories of this store's path
+    @locked
+    def collection(self, name):
+        if name not in self._collections:
+            path = os.path.join(self.path, name) if self.path else None
+            self._collections[name] = NumpyVectorStore(path, self.autosave)
+        return self._collections[name]
+
+    @locked
+    def search(self, embedded_query, top_k, return_fields=None, filters=None):
+        if not self._size:
+            return Result([])
+        query = np.asarray(embedded_query, dtype=np.float32).ravel()
+        query = query / (np.linalg.norm(query) or 1)
+
+        # Prefilter on metadata so only matching rows are scored
+        if filters:
+            rows = np.array(
+                [
+                    row
+                    for row, metadata in enumerate(self._metadata)
+                    if matches_filters(metadata, filters)
+                ],
+                dtype=np.int64,
+            )
+            if not len(rows):
+                return Result([])
+            scores = self.vectors[rows] @ query
+        else:
+            rows = None
+            scores = self.vectors @ query
+
+        # argpartition finds the top_k rows in linear time, only those are then sorted
+        top_k = min(top_k, len(scores))
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates])]
+        ranked = [
+            (int(rows[i]) if rows is not None else int(i), scores[i])
+            for i in candidates
+        ]
+
+        docs = []
+        for row, score in ranked:
+            fields = self._metadata[row]
+            if return_fields is not None:
+                fields = {
+                    name: fields[name] for name in return_fields if name in fields
+                }
+            # Report cosine distance, the same score Redis returns for a COSINE index
+            docs.append(
+                Document(self._keys[row], vector_score=float(1 - score), **fields)
+            )
+        return Result(docs)
+
+    @locked
+    def save(self, path=None):
+        path = path or self.path
+        os.makedirs(path, exist_ok=True)
+        # Write to temporary files first so a crash never leaves a half-written store
+        vectors_path = os.path.join(path, self.VECTORS_FILE)
+        metadata_path = os.path.join(path, self.METADATA_FILE)
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, self.vectors)
+        with open(metadata_path + ".tmp", "w") as f:
+            json.dump({"keys": self._keys, "metadata": self._metadata}, f)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(metadata_path + ".tmp", metadata_path)
+        for collection in self._collections.values():
+            if collection.path:
+                collection.save()
+
+    @locked
+    def load(self, path=None):
+        path = path or self.path
+        self._matrix = np.load(os.path.join(path, self.VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(path, self.METADATA_FILE)) as f:
+            stored = json.load(f)
+        self._keys = stored["keys"]
+        self._metadata = stored["metadata"]
+        self._key_index = {key: row for row, key in enumerate(self._keys)}
+        self._size = len(self._keys)
@@ -16,12 +16,29 @@ def get_answer_from_files(question, session_id, pinecone_index):
     search_query_embedding = get_embedding(question, EMBEDDINGS_MODEL)
 
     try:
+        # Only search chunks, records from before record_type was added are chunks too
+        chunk_filter = {"record_type": {"$ne": "doc"}}
+        if TWO_STAGE_SEARCH:
+            # Find the closest files first, then only search their chunks
+            doc_response = pinecone_index.query(
+                namespace=session_id,
+                top_k=DOC_TOP_K,
+                include_values=False,
+                include_metadata=True,
+                vector=search_query_embedding,
+                filter={"record_type": {"$eq": "doc"}},
+            )
+            filenames = [match.metadata["filename"] for match in doc_response.matches]
+            if filenames:
+                chunk_filter["filename"] = {"$in": filenames}
+
         query_response = pinecone_index.query(
             namespace=session_id,
             top_k=TOP_K,
             include_values=False,
             include_metadata=True,
             vector=search_query_embedding,
+            filter=chunk_filter,
         )
         logging.info(
             f"[get_answer_from_files] received query response from Pinecone: {query_response}")
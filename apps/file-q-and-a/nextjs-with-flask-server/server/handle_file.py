@@ -2,12 +2,13 @@ import logging
 import sys
 import docx2txt
 
+from bisect import bisect_right
 from PyPDF2 import PdfReader
-from numpy import array, average
+import numpy as np
 from flask import current_app
 from config import *
 
-from utils import get_embeddings, get_pinecone_id_for_file_chunk
+from utils import get_embeddings, get_pinecone_id_for_file_chunk, get_pinecone_id_for_file
 
 # Set up logging
 logging.basicConfig(
@@ -78,7 +79,7 @@ def handle_file_string(filename, session_id, file_body_string, pinecone_index, t
 
     # Create embeddings for the text
     try:
-        text_embeddings, average_embedding = create_embeddings_for_text(
+        text_embeddings, document_embedding = create_embeddings_for_text(
             text_to_embed, tokenizer)
         logging.info(
             "[handle_file_string] Created embedding for {}".format(filename))
@@ -88,17 +89,24 @@ def handle_file_string(filename, session_id, file_body_string, pinecone_index, t
         raise e
 
     # Get the vectors array of triples: file_chunk_id, embedding, metadata for each embedding
-    # Metadata is a dict with keys: filename, file_chunk_index
+    # Metadata is a dict with keys: filename, file_chunk_index, record_type
     vectors = []
     for i, (text_chunk, embedding) in enumerate(text_embeddings):
         id = get_pinecone_id_for_file_chunk(session_id, filename, i)
         file_text_dict[id] = text_chunk
         vectors.append(
-            (id, embedding, {"filename": filename, "file_chunk_index": i}))
+            (id, embedding, {"filename": filename, "file_chunk_index": i, "record_type": "chunk"}))
 
         logging.info(
             "[handle_file_string] Text chunk {}: {}".format(i, text_chunk))
 
+    # The whole file's vector is stored as a record of its own, for two-stage searches that
+    # pick the closest files first and then only search their chunks
+    if document_embedding is not None:
+        vectors.append(
+            (get_pinecone_id_for_file(session_id, filename), document_embedding.tolist(),
+             {"filename": filename, "chunk_count": len(text_embeddings), "record_type": "doc"}))
+
     # Split the vectors array into smaller batches of max length 2000
     batch_size = MAX_PINECONE_VECTORS_TO_UPSERT_PATCH_SIZE
     batches = [vectors[i:i+batch_size] for i in range(0, len(vectors), batch_size)]
@@ -116,53 +124,92 @@ def handle_file_string(filename, session_id, file_body_string, pinecone_index, t
                 "[handle_file_string] Error upserting batch of embeddings to Pinecone: {}".format(e))
             raise e
 
-# Compute the column-wise average of a list of lists
-def get_col_average_from_list_of_lists(list_of_lists):
-    """Return the average of each column in a list of lists."""
-    if len(list_of_lists) == 1:
-        return list_of_lists[0]
-    else:
-        list_of_lists_array = array(list_of_lists)
-        average_embedding = average(list_of_lists_array, axis=0)
-        return average_embedding.tolist()
+# Keep a running mean of embeddings in float32 as each batch arrives, optionally weighted
+class EmbeddingAccumulator:
+    """Accumulate a (weighted) mean of embeddings without holding on to all of them."""
+
+    def __init__(self):
+        self.total = None
+        self.weight = 0.0
+
+    def add(self, embeddings, weights=None):
+        """Add a batch of embeddings, each weighted by the matching entry of weights, or 1."""
+        if not len(embeddings):
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        if weights is None:
+            weights = np.ones(len(embeddings), dtype=np.float32)
+        weights = np.asarray(weights, dtype=np.float32)
+        batch_total = weights @ embeddings
+        if self.total is None:
+            self.total = batch_total
+        else:
+            self.total += batch_total
+        self.weight += float(weights.sum())
+
+    def mean(self):
+        """Return the mean of the embeddings added so far, or None if there are none."""
+        if self.total is None or not self.weight:
+            return None
+        return self.total / self.weight
 
 # Create embeddings for a text using a tokenizer and an OpenAI engine
 def create_embeddings_for_text(text, tokenizer):
     """Return a list of tuples (text_chunk, embedding) and an average embedding for a text."""
     token_chunks = list(chunks(text, TEXT_EMBEDDING_CHUNK_SIZE, tokenizer))
     text_chunks = [tokenizer.decode(chunk) for chunk in token_chunks]
+    token_counts = [len(chunk) for chunk in token_chunks]
 
-    # Split text_chunks into shorter arrays of max length 10
-    text_chunks_arrays = [text_chunks[i:i+MAX_TEXTS_TO_EMBED_BATCH_SIZE] for i in range(0, len(text_chunks), MAX_TEXTS_TO_EMBED_BATCH_SIZE)]
-
-    # Call get_embeddings for each shorter array and combine the results
+    # Call get_embeddings for batches of at most MAX_TEXTS_TO_EMBED_BATCH_SIZE chunks, folding each
+    # batch into the average embedding as it arrives
     embeddings = []
-    for text_chunks_array in text_chunks_arrays:
-        embeddings_response = get_embeddings(text_chunks_array, EMBEDDINGS_MODEL)
-        embeddings.extend([embedding["embedding"] for embedding in embeddings_response])
+    accumulator = EmbeddingAccumulator()
+    for i in range(0, len(text_chunks), MAX_TEXTS_TO_EMBED_BATCH_SIZE):
+        embeddings_response = get_embeddings(text_chunks[i:i+MAX_TEXTS_TO_EMBED_BATCH_SIZE], EMBEDDINGS_MODEL)
+        batch_embeddings = [embedding["embedding"] for embedding in embeddings_response]
+        embeddings.extend(batch_embeddings)
+        # Longer chunks count for more in the average, unless configured otherwise
+        weights = token_counts[i:i+MAX_TEXTS_TO_EMBED_BATCH_SIZE] if WEIGHT_DOCUMENT_VECTORS_BY_TOKENS else None
+        accumulator.add(batch_embeddings, weights)
 
     text_embeddings = list(zip(text_chunks, embeddings))
 
-    average_embedding = get_col_average_from_list_of_lists(embeddings)
+    average_embedding = accumulator.mean()
 
     return (text_embeddings, average_embedding)
 
+# Token offsets at which a chunk would end a sentence, i.e. just after a token ending in a full stop or newline
+def get_sentence_end_offsets(tokens, tokenizer):
+    # A decoded chunk ends with "." or "\n" exactly when its last token's bytes do, so each distinct
+    # token only needs decoding once rather than decoding every candidate chunk
+    if hasattr(tokenizer, "decode_single_token_bytes"):
+        decode_token = tokenizer.decode_single_token_bytes
+    else:
+        def decode_token(token):
+            return tokenizer.decode([token]).encode("utf-8")
+    ends_sentence = {}
+    offsets = []
+    for k, token in enumerate(tokens):
+        if token not in ends_sentence:
+            ends_sentence[token] = decode_token(token).endswith((b".", b"\n"))
+        if ends_sentence[token]:
+            offsets.append(k + 1)
+    return offsets
+
 # Split a text into smaller chunks of size n, preferably ending at the end of a sentence
 def chunks(text, n, tokenizer):
-    tokens = tokenizer.encode(text)
     """Yield successive n-sized chunks from text."""
+    tokens = tokenizer.encode(text)
+    sentence_ends = get_sentence_end_offsets(tokens, tokenizer)
     i = 0
     while i < len(tokens):
-        # Find the nearest end of sentence within a range of 0.5 * n and 1.5 * n tokens
+        # Find the furthest end of sentence within a range of 0.5 * n and 1.5 * n tokens
         j = min(i + int(1.5 * n), len(tokens))
-        while j > i + int(0.5 * n):
-            # Decode the tokens and check for full stop or newline
-            chunk = tokenizer.decode(tokens[i:j])
-            if chunk.endswith(".") or chunk.endswith("\n"):
-                break
-            j -= 1
+        k = bisect_right(sentence_ends, j) - 1
+        if k >= 0 and sentence_ends[k] > i + int(0.5 * n):
+            j = sentence_ends[k]
         # If no end of sentence found, use n tokens as the chunk size
-        if j == i + int(0.5 * n):
+        else:
             j = min(i + n, len(tokens))
         yield tokens[i:j]
         i = j
@@ -17,6 +17,9 @@ logging.basicConfig(
 def get_pinecone_id_for_file_chunk(session_id, filename, chunk_index):
     return str(session_id+"-!"+filename+"-!"+str(chunk_index))
 
+def get_pinecone_id_for_file(session_id, filename):
+    return str(session_id+"-!"+filename+"-!doc")
+
 def get_embedding(text, engine):
     return openai.Engine(id=engine).embeddings(input=[text])["data"][0]["embedding"]
 